@@ -2,13 +2,22 @@
 #-*- coding:utf-8 -*-
 
 from blokus3d.viewer import findMove3d
-from blokus3d.mcts import UCT
-from blokus3d.gamestate import saveLegalMovesDic, GameSettings
+from blokus3d.mcts import UCTPlayer, anytimeUCT
+from blokus3d.anytime import anytimePlayer
+from blokus3d.alphabeta import iterativeAlphaBeta
+from blokus3d.gamestate import openLegalMovesStore, closeLegalMovesStore, \
+                               GameSettings
 from blokus3d.match import match
 from blokus3d.ai import libertiesFitness, relativeBaseScoreFitness, \
                         penaltyFitness, minimax, mixtureFitness, \
                         mixtureOneStepHeuristic, oneStepHeuristic
-from blokus3d.utils import randomFromList, timeLimit
+from blokus3d.utils import randomFromList
+import os
+
+# Keep the legal moves computed from one game to the next,
+# in the store given by the BLOKUS3D_STORE environment variable
+if 'BLOKUS3D_STORE' in os.environ:
+    openLegalMovesStore(os.environ['BLOKUS3D_STORE'])
 
 # Create game settings for 2 players
 
@@ -46,27 +55,38 @@ mixture5 = lambda gs: mixtureOneStepHeuristic(gs, [\
                     (0.3,relativeBaseScoreFitness), \
                     (0.2,penaltyFitness)])
 
-minimax1 = lambda gs : timeLimit(10, \
+# Searches that get better with time, stopped after 10 seconds
+
+minimax1 = anytimePlayer(lambda gs : \
                 minimax(gs,mixtureFitness([\
                     (0.3,libertiesFitness), \
                     (0.3,relativeBaseScoreFitness), \
-                    (0.2,penaltyFitness)])))
+                    (0.2,penaltyFitness)])), maxSeconds=10)
 
-minimax2 = lambda gs : timeLimit(10, \
+minimax2 = anytimePlayer(lambda gs : \
                 minimax(gs,mixtureFitness([\
                     (0.5,libertiesFitness), \
                     (0.5,relativeBaseScoreFitness), \
-                    (0.0,penaltyFitness)])))
+                    (0.0,penaltyFitness)])), maxSeconds=10)
+
+minimax3 = anytimePlayer(lambda gs : minimax(gs,libertiesFitness), maxSeconds=10)
 
-minimax3 = lambda gs : timeLimit(10, minimax(gs,libertiesFitness))
+uct = UCTPlayer(gameSettings, 5)
 
-uct = lambda gs: UCT(gameSettings, gs, 5)
+timedUct = anytimePlayer(lambda gs : anytimeUCT(gameSettings, gs), maxSeconds=10)
+
+alphaBeta = anytimePlayer(iterativeAlphaBeta, maxSeconds=10)
 
 # Uncomment to test AIs against each other
 #from blokus3d.match import runCompetition
 #players = [randomMove, oneStepLibertiesFirst]
 #runCompetition(gameSettings, players)
 
+# Uncomment to build an opening book offline, and to use it
+#from blokus3d.book import buildBook, OpeningBook, BookPlayer
+#buildBook(gameSettings, 'opening.book', timedUct, maxPlies=4, nbGames=100, verbose=True)
+#timedUct = BookPlayer(OpeningBook(gameSettings, 'opening.book'), timedUct)
+
 # Choose an opponent (AI) and play against it
 human = lambda gs: findMove3d(gs)
 opponent = mixture1
@@ -76,7 +96,7 @@ endGs = match(gameSettings, [human, opponent], \
               saveCache=False)
 endGs.showScores()
 
-saveLegalMovesDic()
+closeLegalMovesStore()
 
 print "Press ESC to quit"
 findMove3d(endGs, viewOnly=True)
@@ -11,12 +11,17 @@ AI-related functions
 # might to interesting to play immediately)
 
 from numpy.core import hstack, vstack
-from numpy.core.numeric import array, argsort, mean
+from numpy.core.numeric import array, argsort, mean, arange, flatnonzero
 from numpy.core.fromnumeric import argmax
-from matplotlib.mlab import find
+from numpy.lib.function_base import delete
 from itertools import imap, ifilter, izip
+from time import time
 
-from blokus3d.utils import randomFromList, fst, snd, randint, unik
+from blokus3d import instrument
+from blokus3d.utils import randomFromList, fst, snd, unik
+from blokus3d.playout import randomPlayouts
+from blokus3d.bitboard import maskArray, popcount, boardMasks
+from blokus3d.block import blockPenalties
 
 randomMove = lambda gs : randomFromList(gs.legalMoves())
 
@@ -32,16 +37,66 @@ def relativeBaseScoreFitness(gs):
 
 def libertiesFitness(gs):
     """Each legal cube amounts to its square height"""
-    return sum(cube[2]**2 for cube in \
-               gs.libertyCubes([(gs.nextPlayer-1) % gs.nbPlayers]))
+    liberties = gs.libertiesMask([(gs.nextPlayer-1) % gs.nbPlayers])
+    return sum(z*z*popcount(liberties & layer) \
+               for z, layer in enumerate(boardMasks(gs.boardSize).layers))
 
 def penaltyFitness(gs):
     return -gs.penalty()[(gs.nextPlayer-1) % gs.nbPlayers]
 
 def mixtureFitness(weightedFitFuns):
     """Meta-fitness function that make a mix between several"""
-    return lambda gs: sum(weight*fitFun(gs) \
-                           for (weight,fitFun) in weightedFitFuns)
+    mixture = lambda gs: sum(weight*fitFun(gs) \
+                             for (weight,fitFun) in weightedFitFuns)
+    mixture.components = weightedFitFuns
+    return mixture
+
+# Batched fitness functions : the fitness of the next player after each
+# of the given placements (ids in the settings' placement table), all
+# computed at once from the placements' cubes instead of playing them
+
+def batchRelativeBaseScoreFitness(gs, pids):
+    _, _, columns = gs.settings.placements.cellArrays()
+    covered = columns[pids]
+    # Columns topped by each player
+    nbCells = len(gs.bits.heights)*gs.boardSize[2]
+    tops = array([maskArray(occupancy & gs.bits.topMask, nbCells) \
+                  .reshape(-1, gs.boardSize[2]).any(1) \
+                  for occupancy in gs.bits.occupancy], dtype=int).T
+    # The covered columns are lost by their previous owners
+    # and won by the player
+    scores = gs.baseScores() - covered.dot(tops)
+    scores[:,gs.nextPlayer] += covered.sum(1)
+    return scores[:,gs.nextPlayer] - delete(scores, gs.nextPlayer, 1).max(1)
+
+def batchLibertiesFitness(gs, pids):
+    cubes, neighbours, _ = gs.settings.placements.cellArrays()
+    nbCells = cubes.shape[1]
+    liberties = (maskArray(gs.frontier[gs.nextPlayer], nbCells) | neighbours[pids]) \
+                & ~(maskArray(gs.bits.occupied(), nbCells) | cubes[pids])
+    # Each legal cube amounts to its square height
+    return liberties.dot((arange(nbCells) % gs.boardSize[2])**2)
+
+def batchPenaltyFitness(gs, pids):
+    blkIds = gs.settings.placements.blkIds
+    return array([blockPenalties[blkIds[pid]] for pid in pids]) \
+           - gs.penalty()[gs.nextPlayer]
+
+batchFitnesses = {relativeBaseScoreFitness: batchRelativeBaseScoreFitness,
+                  libertiesFitness: batchLibertiesFitness,
+                  penaltyFitness: batchPenaltyFitness}
+
+def batchFitness(fitFun):
+    """Batched version of a fitness function (or mixture
+       of fitness functions), or None if there is none"""
+    if fitFun in batchFitnesses:
+        return batchFitnesses[fitFun]
+    if hasattr(fitFun, 'components'):
+        batches = [(weight, batchFitness(f)) for (weight,f) in fitFun.components]
+        if None not in map(snd, batches):
+            return lambda gs, pids: sum(weight*batch(gs, pids) \
+                                        for (weight,batch) in batches)
+    return None
 
 def bestMoves(gs, fitFun, moves=None):
     """Select the best legal moves according to
@@ -50,11 +105,24 @@ def bestMoves(gs, fitFun, moves=None):
         moves = gs.legalMoves()
     if moves == []:
         return [None], None
-    fitnesses = array([fitFun(gs.clone().playMove(move)) \
-                       for move in moves])
+    if instrument.enabled:
+        instrument.count('fitness.evaluations', len(moves))
+        start = time()
+    batch = batchFitness(fitFun)
+    if batch != None and moves != [None]:
+        table = gs.settings.placements
+        fitnesses = batch(gs, [table.placementId(move) for move in moves])
+    else:
+        fitnesses = []
+        for move in moves:
+            fitnesses.append(fitFun(gs.playMove(move)))
+            gs.undoMove()
+        fitnesses = array(fitnesses)
+    if instrument.enabled:
+        instrument.addTime('fitness', time()-start)
     bestFitness = max(fitnesses)
     # TODO should use argsort instead
-    selectedMoves = map(moves.__getitem__,find(fitnesses==bestFitness))
+    selectedMoves = map(moves.__getitem__,flatnonzero(fitnesses==bestFitness))
     return selectedMoves, bestFitness
 
 # Heuristics based on fitness functions
@@ -103,7 +171,7 @@ def threeHeuristicsMC(gs, verbose=False):
 
 # Meta-heuristic
 
-# TODO add depth so it can be maximini...maximinimax !
+# Two steps only : see the alphabeta module for deeper searches
 def minimax(gs, fitFun):
     # Get the legal moves and return immediately if there are only one
     moves = gs.legalMoves()
@@ -113,42 +181,31 @@ def minimax(gs, fitFun):
         raise StopIteration
     # Get the one-step fitness for each possible move
     fitnesses = []
-    nextGss = []
     for move in moves:
-        nextGs = gs.clone().playMove(move)
-        fitnesses.append(fitFun(nextGs))
-        nextGss.append(nextGs)
+        fitnesses.append(fitFun(gs.playMove(move)))
+        gs.undoMove()
     bestMovesOrder = argsort(fitnesses)[::-1]
     bestSoFar = moves[bestMovesOrder[0]]
     yield bestSoFar
     # Find the one-step that minimize the opponent fitness (second step)
-    leastBestEnemyFitness = snd(bestMoves(nextGss[bestMovesOrder[0]].clone(),fitFun))
+    leastBestEnemyFitness = snd(bestMoves(gs.playMove(bestSoFar),fitFun))
+    gs.undoMove()
     for num,idx in enumerate(bestMovesOrder):
         print "processing move %d/%d (fitness %d)" % (num+1,lnMoves,fitnesses[idx])
-        bestEnemyFitness = snd(bestMoves(nextGss[idx].clone(),fitFun))
+        bestEnemyFitness = snd(bestMoves(gs.playMove(moves[idx]),fitFun))
+        gs.undoMove()
         if bestEnemyFitness < leastBestEnemyFitness:
             bestSoFar = moves[idx]
             leastBestEnemyFitness = bestEnemyFitness
             print "new least best enemy fitness : %d" % leastBestEnemyFitness
-        # TODO the yield is only here to avoid blocking on timeLimit,
-        # must be removed when timeLimit works asynchronously
+        # Give the best move so far to anytime searches
         yield bestSoFar
 
 # Some other functions
 
 def monteCarloScores(gs, maxDepth=None):
-    # Copy the game state, so we can keep the original
-    gs = gs.clone()
-    depth = 0
-    while not gs.isOver() and (maxDepth==None or depth<maxDepth):
-        lm = gs.legalMoves()
-        if lm != []:
-            choice = randint(len(lm))
-            gs.playMove(lm[choice])
-            depth += 1
-        else:
-            gs.playMove(None) # passing move
-    return gs.finalScores()
+    """Final scores of a random game starting from gs"""
+    return randomPlayouts(gs, 1, maxDepth=maxDepth)[0]
 
 def monteCarloHeuristic(gs, moves=None, maxDepth=None, verbose=False):
     """Determines the best move using a Monte-Carlo estimation
@@ -159,8 +216,7 @@ def monteCarloHeuristic(gs, moves=None, maxDepth=None, verbose=False):
     relativeScoreGrid = [[] for _ in xrange(len(moves))]
     for trial in xrange(1000000):
         for m in xrange(len(moves)):
-            scores = nextStates[m].monteCarloScores(\
-                        gs,maxDepth=maxDepth)
+            scores = monteCarloScores(nextStates[m],maxDepth=maxDepth)
             if verbose:
                 print "trial %d, move %d/%d, scores : %s" \
                       % (trial+1, m+1, len(moves), scores)
@@ -201,14 +257,15 @@ def bruteForceTree(gs, root=(None,[]), saveGs=False, depth=2):
     for i,node in enumerate(root[1]):
         # Play the move
         move = node[0]['move']
-        nextGs = gs.clone().playMove(move)
+        gs.playMove(move)
         if saveGs:
-            node[0]['gs'] = nextGs
+            node[0]['gs'] = gs.clone()
         # Evaluate the scores
-        node[0]['baseScores'] = nextGs.baseScores()
-        node[0]['penalty'] = nextGs.penalty()
+        node[0]['baseScores'] = gs.baseScores()
+        node[0]['penalty'] = gs.penalty()
         # Recursion
-        nextGs.bruteForceTree(root=node,saveGs=saveGs,depth=depth-1)
+        bruteForceTree(gs,root=node,saveGs=saveGs,depth=depth-1)
+        gs.undoMove()
         # DEBUG
         if depth==2:
             print "done node %d/%d" % (i,len(root[1]))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Depth-limited alpha-beta search
+
+With more than two players, the search is paranoid : the other
+players are assumed to play together against the root player (the
+one whose best move is searched), so that the game can be searched
+like a two-player one.
+"""
+
+from blokus3d.cache import LRUCache
+from blokus3d.mcts import scoreDiff, stateKey
+from blokus3d.symmetry import symmetryTable
+
+# Kinds of values in the transposition table
+exact, lowerBound, upperBound = 0, 1, 2
+
+infinity = float('inf')
+
+def scoreMargin(gs, player):
+    """Score of a player minus the best score of his opponents,
+       counting the penalties once the game is over"""
+    scores = gs.finalScores() if gs.isOver() else gs.baseScores()
+    return int(scoreDiff(scores, player))
+
+class AlphaBeta(object):
+    """Paranoid alpha-beta search of the best move of a game state's next
+       player, with a transposition table of at most tableSize entries and
+       killer and history heuristics to order the moves. Positions are
+       evaluated by evalFun(gs, rootPlayer), from the root player's side.
+       The statistics are kept from one search to the next, which makes
+       iterative deepening cheap."""
+
+    def __init__(self, gs, evalFun=scoreMargin, tableSize=1000000):
+        # Placements are played and taken back on a copy of gs
+        self.gs = gs.clone()
+        self.rootPlayer = gs.nextPlayer
+        self.evalFun = evalFun
+        self.table = LRUCache(maxSize=tableSize, weight=lambda entry: 1)
+        # killers[ply] are the last two placements that caused a cutoff
+        self.killers = {}
+        # history[pid] sums the squared depths of its cutoffs
+        self.history = {}
+        self.nodes = 0
+
+    def orderedPlacements(self, ply, tablePid):
+        """Legal placements of the next player (or [None] for passing),
+           the most promising first"""
+        pids = self.gs.legalPlacements()
+        if pids == []:
+            return [None]
+        if ply == 0:
+            # Symmetric placements lead to equivalent subtrees
+            pids = symmetryTable(self.gs.boardSize).pruneSymmetricPlacements(self.gs, pids)
+        killers = self.killers.get(ply, ())
+        history = self.history
+        return sorted(pids, reverse=True, key=lambda pid: \
+                      (pid == tablePid, pid in killers, history.get(pid, 0)))
+
+    def search(self, depth, alpha=-infinity, beta=infinity, ply=0):
+        """Value of the state for the root player, searching depth plies
+           ahead, and best placement id of the next player"""
+        gs = self.gs
+        self.nodes += 1
+        if depth == 0 or gs.isOver():
+            return self.evalFun(gs, self.rootPlayer), None
+        key = stateKey(gs)
+        entry = self.table.get(key)
+        tablePid = None
+        if entry != None:
+            entryDepth, value, kind, tablePid = entry
+            if entryDepth >= depth:
+                if kind == exact:
+                    return value, tablePid
+                elif kind == lowerBound:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value, tablePid
+        alphaOrig, betaOrig = alpha, beta
+        maximizing = gs.nextPlayer == self.rootPlayer
+        best, bestPid = None, None
+        for pid in self.orderedPlacements(ply, tablePid):
+            gs.playPlacement(pid)
+            value, _ = self.search(depth-1, alpha, beta, ply+1)
+            gs.undoMove()
+            if maximizing:
+                if best == None or value > best:
+                    best, bestPid = value, pid
+                alpha = max(alpha, value)
+            else:
+                if best == None or value < best:
+                    best, bestPid = value, pid
+                beta = min(beta, value)
+            if alpha >= beta:
+                killers = self.killers.setdefault(ply, [])
+                if pid not in killers:
+                    killers.insert(0, pid)
+                    del killers[2:]
+                self.history[pid] = self.history.get(pid, 0) + depth*depth
+                break
+        if best <= alphaOrig:
+            kind = upperBound
+        elif best >= betaOrig:
+            kind = lowerBound
+        else:
+            kind = exact
+        self.table[key] = (depth, best, kind, bestPid)
+        return best, bestPid
+
+    def maxPlies(self):
+        """Number of plies after which the game is surely over"""
+        return sum(len(blocks) for blocks in self.gs.playerBlocks) \
+               + self.gs.nbPlayers
+
+    def bestMove(self, depth):
+        _, pid = self.search(depth)
+        return None if pid == None else self.gs.settings.placements.moves[pid]
+
+    def iterativeDeepening(self, maxDepth=None, verbose=False):
+        """Generator yielding the best move found by searches of depth
+           1, 2, ... up to maxDepth (or until the end of the game)"""
+        if maxDepth == None:
+            maxDepth = self.maxPlies()
+        for depth in xrange(1, maxDepth+1):
+            move = self.bestMove(depth)
+            if verbose:
+                print "depth %d : %d nodes, table %s" \
+                      % (depth, self.nodes, self.table.stats())
+            yield move
+
+def alphaBeta(gs, depth, evalFun=scoreMargin):
+    """Best move according to an alpha-beta search of depth plies"""
+    return AlphaBeta(gs, evalFun).bestMove(depth)
+
+def iterativeAlphaBeta(gs, maxDepth=None, evalFun=scoreMargin, verbose=False):
+    """Iterative deepening alpha-beta search, as a generator
+       yielding better and better moves (see the anytime module)"""
+    return AlphaBeta(gs, evalFun).iterativeDeepening(maxDepth, verbose)
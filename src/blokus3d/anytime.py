@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Anytime search
+
+The AIs written as generators (minimax, monteCarloHeuristic,
+threeHeuristicsMC, anytimeUCT...) yield better and better moves
+as they go. Here, they are run in a background worker process, so
+that the best move found so far can be returned as soon as a deadline
+is reached, even in the middle of a step : the worker is then killed,
+and does not slow down what comes next.
+"""
+
+from multiprocessing import Process, Pipe, RawArray
+from time import time
+import traceback
+
+from blokus3d.utils import randomFromList
+
+class SearchError(Exception):
+    pass
+
+def _searchWorker(searchFun, gs, maxIterations, best, errors):
+    """Run searchFun(gs), writing in best the number of moves
+       yielded so far and the placement id of the last one"""
+    try:
+        table = gs.settings.placements
+        iterations = 0
+        for move in searchFun(gs):
+            iterations += 1
+            # The move goes first, so that the caller can
+            # read it as soon as it sees the iterations
+            best[1] = -1 if move == None else table.placementId(move)
+            best[0] = iterations
+            if maxIterations != None and iterations >= maxIterations:
+                break
+    except Exception:
+        errors.send(traceback.format_exc())
+
+def anytimeSearch(searchFun, gs, maxSeconds=None, maxIterations=None, verbose=False):
+    """Returns the last move yielded by the generator searchFun(gs)
+       within maxSeconds seconds and maxIterations yields (at least one
+       of the two budgets must be given). If no move was yielded before
+       the deadline, a random legal move is returned.
+       The search is made in a forked process, so gs is left untouched,
+       and anything the search learns (e.g., cached legal moves)
+       is lost, except for what goes to the legal moves store."""
+    assert maxSeconds != None or maxIterations != None
+    start = time()
+    best = RawArray('l', [0, -1])
+    errorsIn, errorsOut = Pipe(duplex=False)
+    worker = Process(target=_searchWorker, \
+                     args=(searchFun, gs, maxIterations, best, errorsOut))
+    worker.daemon = True
+    worker.start()
+    worker.join(None if maxSeconds == None \
+                else max(0., start+maxSeconds-time()))
+    iterations, pid = best[0], best[1]
+    if worker.is_alive():
+        worker.terminate()
+        worker.join()
+    elif errorsIn.poll():
+        raise SearchError(errorsIn.recv())
+    if verbose:
+        print "%d iterations in %f seconds" % (iterations, time()-start)
+    if iterations == 0:
+        return randomFromList(gs.legalMoves())
+    return None if pid == -1 else gs.settings.placements.moves[pid]
+
+def anytimePlayer(searchFun, maxSeconds=None, maxIterations=None, verbose=False):
+    """Decision function of a player using anytimeSearch"""
+    return lambda gs: anytimeSearch(searchFun, gs, maxSeconds=maxSeconds, \
+                                    maxIterations=maxIterations, verbose=verbose)
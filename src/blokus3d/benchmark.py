@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Benchmarks of move generation, playouts and searches
+
+Every benchmark is run on a fixed corpus of positions (the opening, a
+midgame and an endgame position of a seeded random game, for 2, 3 and 4
+players), with fixed seeds and the legal moves cache disabled, so that
+two runs on the same machine measure the same work.
+
+Usage :
+    python -m blokus3d.benchmark [-o results.json] [-b baseline.json]
+
+Results are given in seconds per operation. When a baseline is given,
+the benchmarks that got slower by more than the tolerance are reported
+and the exit status is 1.
+"""
+
+from time import time
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+
+import numpy.random
+
+from blokus3d.gamestate import GameSettings, GameState, setLegalMovesCache
+from blokus3d.cache import LRUCache
+from blokus3d.playout import playout
+from blokus3d.mcts import UCTSearch
+from blokus3d.ai import oneStepHeuristic, mixtureOneStepHeuristic, \
+                        libertiesFitness, relativeBaseScoreFitness, penaltyFitness
+from blokus3d.utils import randomFromList
+
+# The positions of the corpus are taken at these fractions of a game
+phases = (('opening', 0.), ('midgame', 1./3), ('endgame', 2./3))
+
+corpusSeed = 1234
+
+# Decision functions whose latency is measured
+heuristics = (
+    ('oneStep', lambda gs: oneStepHeuristic(gs, [\
+                    libertiesFitness, relativeBaseScoreFitness, penaltyFitness])),
+    ('mixture', lambda gs: mixtureOneStepHeuristic(gs, [\
+                    (0.4,libertiesFitness), (0.4,relativeBaseScoreFitness), \
+                    (0.1,penaltyFitness)])),
+    )
+
+def seedAll(seed):
+    random.seed(seed)
+    numpy.random.seed(seed)
+
+def corpus(nbPlayersList=(2,3,4)):
+    """List of (name, game state) of the benchmark positions"""
+    positions = []
+    for nbPlayers in nbPlayersList:
+        settings = GameSettings(nbPlayers)
+        # Play a whole random game to know its length, then replay it
+        seedAll(corpusSeed+nbPlayers)
+        gs = GameState.initState(settings)
+        length = 0
+        while not gs.isOver():
+            gs.playMove(randomFromList(gs.legalMoves()))
+            length += 1
+        for phase, fraction in phases:
+            seedAll(corpusSeed+nbPlayers)
+            gs = GameState.initState(settings)
+            for _ in xrange(int(fraction*length)):
+                gs.playMove(randomFromList(gs.legalMoves()))
+            positions.append(("%dp-%s" % (nbPlayers, phase), gs))
+    return positions
+
+def timeIt(fun, minSeconds=0.2, repeat=3):
+    """Seconds per call of fun, best of repeat runs
+       of at least minSeconds each"""
+    fun() # Warm up (e.g., build the placement tables)
+    best = None
+    for _ in xrange(repeat):
+        calls, start = 0, time()
+        while True:
+            fun()
+            calls += 1
+            elapsed = time()-start
+            if elapsed >= minSeconds:
+                break
+        best = elapsed/calls if best == None else min(best, elapsed/calls)
+    return best
+
+def _playoutFun(gs, seed):
+    gs = gs.clone()
+    def fun():
+        # Reseeded, so that every call replays the same playout
+        for _ in xrange(playout(gs, random.Random(seed))):
+            gs.undoMove()
+    return fun
+
+def _uctFun(gs, iterations):
+    def fun():
+        seedAll(corpusSeed)
+        UCTSearch(gs.settings, gs, iterations)
+    return fun
+
+def _heuristicFun(gs, decision):
+    def fun():
+        seedAll(corpusSeed)
+        decision(gs)
+    return fun
+
+def importSeconds(module='blokus3d.gamestate', repeat=3):
+    """Seconds needed to import a module in a fresh interpreter"""
+    code = "from time import time; t = time(); import %s; print time()-t" % module
+    return min(float(subprocess.check_output([sys.executable, '-c', code])) \
+               for _ in xrange(repeat))
+
+def runBenchmarks(minSeconds=0.2, uctIterations=20, nbPlayersList=(2,3,4), \
+                  verbose=False):
+    """Dict of benchmark names to seconds per operation"""
+    previousCache = setLegalMovesCache(LRUCache(maxSize=0))
+    results = {}
+    def record(name, seconds):
+        results[name] = seconds
+        if verbose:
+            print "%-36s %12.6f s %12.1f /s" % (name, seconds, 1./seconds)
+    try:
+        for name, gs in corpus(nbPlayersList):
+            record(name+'/legalMoves', timeIt(gs.legalMoves, minSeconds))
+            record(name+'/clone', timeIt(gs.clone, minSeconds))
+            if not gs.isOver():
+                record(name+'/playout', timeIt(_playoutFun(gs, corpusSeed), minSeconds))
+                record(name+'/uctIteration', timeIt(_uctFun(gs, uctIterations), \
+                                                    minSeconds)/uctIterations)
+                for hName, decision in heuristics:
+                    record(name+'/'+hName, timeIt(_heuristicFun(gs, decision), \
+                                                  minSeconds))
+        record('import', importSeconds())
+    finally:
+        setLegalMovesCache(previousCache)
+    return results
+
+def compare(results, baseline, tolerance=0.15):
+    """Prints the speedup of each benchmark over the baseline, and
+       returns the names of those that got slower than tolerance allows"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        speedup = baseline[name]/results[name]
+        slower = speedup < 1./(1.+tolerance)
+        if slower:
+            regressions.append(name)
+        print "%-36s %12.6f s %7.2fx%s" % \
+            (name, results[name], speedup, "  SLOWER" if slower else "")
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Blokus 3D benchmarks")
+    parser.add_argument('-o', '--output', help="JSON file to write the results to")
+    parser.add_argument('-b', '--baseline', help="JSON results to compare with")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.15, \
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('-s', '--min-seconds', type=float, default=0.2, \
+                        help="minimum duration of each timing")
+    parser.add_argument('-p', '--players', default='2,3,4', \
+                        help="numbers of players of the positions")
+    args = parser.parse_args(args)
+    nbPlayersList = map(int, args.players.split(','))
+    results = runBenchmarks(args.min_seconds, nbPlayersList=nbPlayersList, \
+                            verbose=args.baseline == None)
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), \
+                       'numpy': numpy.__version__, \
+                       'machine': platform.platform(), \
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions != []:
+            print "%d benchmarks got slower" % len(regressions)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
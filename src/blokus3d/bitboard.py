@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Compact board representation based on bitmasks
+
+Cell (x,y,z) is stored as bit (x*sizeY+y)*sizeZ+z, so that each
+column of the board is a contiguous run of sizeZ bits.
+"""
+
+from numpy.core import vstack
+from numpy.core.numeric import array
+from itertools import product
+
+def popcount(mask):
+    """Number of bits set in mask"""
+    return bin(mask).count('1')
+
+def maskArray(mask, nbCells):
+    """Boolean array of the first nbCells bits of mask"""
+    return array([(mask >> i) & 1 for i in xrange(nbCells)], dtype=bool)
+
+def iterBits(mask):
+    """Yields the index of every bit set in mask, in increasing order"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length()-1
+        mask ^= low
+
+class BoardMasks(object):
+    """Constant masks of a board size, used to shift
+       bitmasks without wrapping between columns"""
+
+    def __init__(self, boardSize):
+        sizeX, sizeY, sizeZ = boardSize
+        self.columnStride = sizeZ
+        self.rowStride = sizeY*sizeZ
+        self.full = (1 << (sizeX*sizeY*sizeZ))-1
+        column = (1 << sizeZ)-1
+        self.floor = self.notTop = self.notLastY = self.notFirstY = 0
+        for x in xrange(sizeX):
+            for y in xrange(sizeY):
+                offset = (x*sizeY+y)*sizeZ
+                self.floor |= 1 << offset
+                self.notTop |= (column >> 1) << offset
+                if y < sizeY-1:
+                    self.notLastY |= column << offset
+                if y > 0:
+                    self.notFirstY |= column << offset
+        self.layers = [self.floor << z for z in xrange(sizeZ)]
+
+    def neighbours(self, mask):
+        """Cells next to or above the cells of mask"""
+        return ((mask & self.notTop) << 1) \
+             | ((mask & self.notLastY) << self.columnStride) \
+             | ((mask & self.notFirstY) >> self.columnStride) \
+             | ((mask << self.rowStride) & self.full) \
+             | (mask >> self.rowStride)
+
+_masks = {}
+
+def boardMasks(boardSize):
+    if boardSize not in _masks:
+        _masks[boardSize] = BoardMasks(boardSize)
+    return _masks[boardSize]
+
+class BitBoard(object):
+    """Board made of one occupancy bitmask per player,
+       a height array and a mask of the top cube of each column"""
+
+    __slots__ = ('boardSize', 'heights', 'occupancy', 'topMask')
+
+    def __init__(self, boardSize, nbPlayers, heights=None, occupancy=None, topMask=0):
+        self.boardSize = boardSize
+        self.heights = heights if heights != None \
+                       else [0]*(boardSize[0]*boardSize[1])
+        self.occupancy = occupancy if occupancy != None else [0]*nbPlayers
+        self.topMask = topMask
+
+    @classmethod
+    def fromLists(cls, boardSize, nbPlayers, board):
+        """Build a BitBoard from a list-of-lists-of-lists of player ids"""
+        bits = cls(boardSize, nbPlayers)
+        for x,y in product(xrange(boardSize[0]),xrange(boardSize[1])):
+            for player in board[x][y]:
+                bits.place(x, y, player)
+        return bits
+
+    def toLists(self):
+        """Returns the board as a list-of-lists-of-lists of player ids"""
+        return [[[self.owner(x,y,z) for z in xrange(self.height(x,y))] \
+                 for y in xrange(self.boardSize[1])] \
+                for x in xrange(self.boardSize[0])]
+
+    def __getstate__(self):
+        return (self.boardSize, self.heights, self.occupancy, self.topMask)
+
+    def __setstate__(self, state):
+        self.boardSize, self.heights, self.occupancy, self.topMask = state
+
+    def columnIndex(self, x, y):
+        return x*self.boardSize[1]+y
+
+    def cellIndex(self, x, y, z):
+        return (int(x)*self.boardSize[1]+int(y))*self.boardSize[2]+int(z)
+
+    def cellCoords(self, idx):
+        col, z = divmod(idx, self.boardSize[2])
+        x, y = divmod(col, self.boardSize[1])
+        return x, y, z
+
+    def height(self, x, y):
+        return self.heights[x*self.boardSize[1]+y]
+
+    def owner(self, x, y, z):
+        """Returns the player owning cube (x,y,z), or None if empty"""
+        bit = 1 << self.cellIndex(x,y,z)
+        for player, occ in enumerate(self.occupancy):
+            if occ & bit:
+                return player
+        return None
+
+    def occupied(self):
+        """Mask of all the cubes on the board"""
+        mask = 0
+        for occ in self.occupancy:
+            mask |= occ
+        return mask
+
+    def liberties(self, players):
+        """Mask of the empty cells next to or above
+           the given players' cubes"""
+        mask = 0
+        for player in players:
+            mask |= self.occupancy[player]
+        return boardMasks(self.boardSize).neighbours(mask) & ~self.occupied()
+
+    def place(self, x, y, player):
+        """Put a cube of the given player on top of column (x,y)"""
+        # Coordinates might be numpy integers, which would overflow
+        col = int(x)*self.boardSize[1]+int(y)
+        z = self.heights[col]
+        assert z < self.boardSize[2]
+        bit = 1 << (col*self.boardSize[2]+z)
+        self.occupancy[player] |= bit
+        if z > 0:
+            self.topMask ^= bit >> 1
+        self.topMask |= bit
+        self.heights[col] = z+1
+
+    def placeBlock(self, mask, player, tops):
+        """Put the cubes of mask on the board, tops being the
+           (column, height afterwards) pairs of the columns they cover"""
+        self.occupancy[player] |= mask
+        sizeZ = self.boardSize[2]
+        for col, height in tops:
+            z = self.heights[col]
+            if z > 0:
+                self.topMask &= ~(1 << (col*sizeZ+z-1))
+            self.topMask |= 1 << (col*sizeZ+height-1)
+            self.heights[col] = height
+
+    def removeBlock(self, mask, player, bottoms):
+        """Take the cubes of mask off the board, bottoms being the
+           (column, height afterwards) pairs of the columns they cover"""
+        self.occupancy[player] &= ~mask
+        sizeZ = self.boardSize[2]
+        for col, height in bottoms:
+            self.topMask &= ~(1 << (col*sizeZ+self.heights[col]-1))
+            if height > 0:
+                self.topMask |= 1 << (col*sizeZ+height-1)
+            self.heights[col] = height
+
+    def cubes(self, players):
+        """Yields the (x,y,z) coordinates of the given players' cubes"""
+        mask = 0
+        for player in players:
+            mask |= self.occupancy[player]
+        for idx in iterBits(mask):
+            yield self.cellCoords(idx)
+
+    def coordsArray(self, mask):
+        """Coordinates of the cells of mask, as a n*3 array"""
+        sizeY, sizeZ = self.boardSize[1], self.boardSize[2]
+        cells = array(list(iterBits(mask)), dtype=int)
+        return vstack((cells // (sizeY*sizeZ), cells // sizeZ % sizeY, cells % sizeZ)).T
+
+    def surface(self):
+        """Mask of the lowest empty cell of every column that is not full"""
+        masks = boardMasks(self.boardSize)
+        return ((self.topMask & masks.notTop) << 1) | (masks.floor & ~self.occupied())
+
+    def topCounts(self):
+        """Number of columns topped by each player"""
+        return [popcount(occ & self.topMask) for occ in self.occupancy]
+
+    def clone(self):
+        return BitBoard(self.boardSize, len(self.occupancy), \
+                        list(self.heights), list(self.occupancy), self.topMask)
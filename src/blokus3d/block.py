@@ -3,15 +3,18 @@ Module containing the block definitions
 and functions for block manipulation (e.g., rotation)
 """
 
-from numpy.core import vstack
-from numpy.core.numeric import lexsort, array, argsort, dot, zeros
+from numpy.core import vstack, hstack
+from numpy.core.numeric import lexsort, array, asarray, argsort, dot, zeros
+from numpy.core.numerictypes import int8, int32
 from numpy.lib.shape_base import dstack
 from numpy.lib.twodim_base import flipud, diag
-from numpy.lib.npyio import load
-from matplotlib.pylab import flatten
-from itertools import ifilter
+from numpy.lib.npyio import load, savez
+from itertools import ifilter, product
+from zipfile import BadZipfile
+from zlib import crc32
+import os
 
-from blokus3d.utils import third, uniqueIdx
+from blokus3d.utils import third
 
 # Sort by increasing z, then y, then x
 sortCubes = lambda blk : blk[lexsort(blk.T)]
@@ -37,6 +40,9 @@ blocks = [ sortCubes(x) for x in [ \
 
 nbBlocks = len(blocks)
 
+# Penalty of each block, if it is not played
+blockPenalties = [blk.shape[0] for blk in blocks]
+
 blockNames = ( \
   "2-cube bar", \
   "3-cube bar", \
@@ -90,7 +96,7 @@ def cmpCubesPos(c1,c2):
     return 0
 
 def argsortBlocks(blocks):
-    return argsort(map(flatten, blocks))
+    return argsort([asarray(blk).ravel().tolist() for blk in blocks])
 
 # Use the nth cube in the block as the new origin
 def changeOrigin(blk, n):
@@ -123,31 +129,123 @@ def blockToASCII(blk, showOrigin=False):
 def containsCube(blk, cube):
     return 0 < len(list(ifilter(lambda other : (cube==other).all(), blk)))
 
+def variationKeys(blkId):
+    """Canonical keys of the distinct variations of a block : the sorted
+       tuple of its cubes (but the origin) once rotated, for each rotation
+       and each cube taken as the origin, sorted by increasing key"""
+    keys = set()
+    for rotx, roty, rotz in product(xrange(4), repeat=3):
+        cubes = [(0,0,0)] + map(tuple, rotateBlock(blocks[blkId], rotx, roty, rotz).tolist())
+        for ox, oy, oz in cubes:
+            # Sorted by increasing z, then y, then x, like sortCubes
+            keys.add(tuple(sorted(((x-ox,y-oy,z-oz) for x,y,z in cubes \
+                                   if (x,y,z) != (ox,oy,oz)), \
+                                  key=lambda cube: cube[::-1])))
+    return sorted(keys)
+
 def computeBlocksVar():
     """
     Compute all the variations of each block,
-    such that blocksVar[k][j][k] is the ith cube
+    such that blocksVar[k][i,:,j] is the ith cube
     of the jth variation of the kth block
     """
-    _blocksVar = [[] for _ in xrange(nbBlocks)]
-    for k in xrange(nbBlocks):
-        for rotx in xrange(4):
-            for roty in xrange(4):
-                for rotz in xrange(4):
-                    b = rotateBlock(blocks[k], rotx, roty, rotz)
-                    for o in xrange(b.shape[0]+1):
-                        _blocksVar[k].append(changeOrigin(b, o))
-        uniIdx = uniqueIdx(_blocksVar[k])
-        _blocksVar[k] = dstack(_blocksVar[k])
-        _blocksVar[k] = _blocksVar[k][:,:,uniIdx]
-    return _blocksVar
-
-# XXX Generate the blocksVar cache file if not found
-# Saving blocksVar to a file for caching purposes
-#blocksVar = computeBlocksVar()
-#save('blocksVar.dat',blocksVar)
-# Loading blocksVar from cache
-blocksVar = load('blocksVar.dat.npy') # blocksVar[i] shape : cubes x coordinates x variations
+    return [dstack([array(key) for key in variationKeys(k)]) \
+            for k in xrange(nbBlocks)]
+
+class BlockVarTable(object):
+    """The variations of all the blocks as a single contiguous cubes x
+       coordinates array : cubes[offsets[k]:offsets[k+1]] are the cubes
+       (but the origin) of the nbVars[k] variations of the kth block,
+       one after the other, and varOffsets[k] is the index of its first
+       variation among all the variations. checksum is a CRC of the
+       table, which tells whether two tables give the same meaning to
+       variation ids."""
+
+    def __init__(self, cubes, nbVars):
+        self.cubes = cubes
+        self.nbVars = array(nbVars, dtype=int32)
+        self.nbCubes = array(blockPenalties, dtype=int32)
+        self.offsets = hstack([0, (self.nbVars*self.nbCubes).cumsum()]).astype(int32)
+        self.varOffsets = hstack([0, self.nbVars.cumsum()]).astype(int32)
+        self.checksum = crc32(self.cubes.tostring() + self.nbVars.tostring()) & 0xffffffff
+
+    @classmethod
+    def generate(cls):
+        keys = [variationKeys(k) for k in xrange(nbBlocks)]
+        cubes = array([c for blkKeys in keys for key in blkKeys \
+                       for cube in key for c in cube], dtype=int8).reshape(-1,3)
+        return cls(cubes, map(len, keys))
+
+    def variations(self, blkId):
+        """View of the variations of a block, as a
+           variations x cubes x coordinates array"""
+        return self.cubes[self.offsets[blkId]:self.offsets[blkId+1]] \
+                   .reshape(self.nbVars[blkId], self.nbCubes[blkId], 3)
+
+    def save(self, path):
+        """Write the table at path, replacing the file at once"""
+        tmpPath = path+'.tmp'
+        with open(tmpPath,'wb') as f:
+            savez(f, cubes=self.cubes, nbVars=self.nbVars, \
+                  checksum=self.checksum, sourceChecksum=sourceChecksum())
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        """The table saved at path, or None if it is missing, damaged,
+           or was generated from other block definitions"""
+        try:
+            with load(path) as data:
+                table = cls(data['cubes'], data['nbVars'])
+                valid = table.checksum == int(data['checksum']) \
+                        and int(data['sourceChecksum']) == sourceChecksum()
+        except (IOError, KeyError, ValueError, BadZipfile):
+            return None
+        return table if valid else None
+
+def sourceChecksum():
+    """CRC of what the variations are computed from"""
+    return crc32(repr(([blk.tolist() for blk in blocks], \
+                       [[mat.tolist() for mat in rotmat] \
+                        for rotmat in (rotxmat, rotymat, rotzmat)]))) & 0xffffffff
+
+# The variations table is cached next to this module, unless the
+# BLOKUS3D_BLOCKSVAR environment variable tells otherwise
+blocksVarPath = os.environ.get('BLOKUS3D_BLOCKSVAR', \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocksVar.npz'))
+
+_blockVarTable = None
+
+def blockVarTable():
+    """The table of the block variations, loaded on first use from
+       blocksVarPath, or generated (and saved there, if possible)
+       if it is missing or does not match the block definitions"""
+    global _blockVarTable
+    if _blockVarTable == None:
+        table = BlockVarTable.load(blocksVarPath)
+        if table == None:
+            table = BlockVarTable.generate()
+            try:
+                table.save(blocksVarPath)
+            except (IOError, OSError):
+                pass # e.g., read-only installation
+        _blockVarTable = table
+    return _blockVarTable
+
+class LazyBlocksVar(object):
+    """The variations of the blocks, blocksVar[k] being those of the kth
+       block as a cubes x coordinates x variations view of blockVarTable"""
+
+    def __getitem__(self, blkId):
+        return blockVarTable().variations(blkId).transpose(1,2,0)
+
+    def __len__(self):
+        return nbBlocks
+
+    def __iter__(self):
+        return (self[blkId] for blkId in xrange(nbBlocks))
+
+blocksVar = LazyBlocksVar() # blocksVar[i] shape : cubes x coordinates x variations
 
 def blockHeight(blk):
     x = map(third, blk)+[0]
@@ -156,6 +254,43 @@ def blockHeight(blk):
 def blockVarWithOrigin(blkId, blkVarId):
     return sortCubes(vstack([array([0,0,0]), blocksVar[blkId][:,:,blkVarId]]))
 
+_blockVarsWithOrigin = {}
+
+def blockVarsWithOrigin(blkId):
+    """All the variations of a block including their origin, as a
+       cubes x coordinates x variations array, and a cubes x variations
+       boolean array telling which cubes lie on a cube of the block"""
+    if blkId not in _blockVarsWithOrigin:
+        blkVars = blocksVar[blkId].astype(int)
+        cubes = vstack([zeros((1,3,blkVars.shape[2]),dtype=int), blkVars])
+        lowered = cubes - array([0,0,1])[None,:,None]
+        below = (lowered[:,None,:,:] == cubes[None,:,:,:]).all(2).any(1)
+        _blockVarsWithOrigin[blkId] = (cubes, below)
+    return _blockVarsWithOrigin[blkId]
+
+def blockCells(blkId, anchors):
+    """Coordinates of the cubes of every variation of a block placed
+       at each anchor, as an anchors x cubes x coordinates x variations
+       array"""
+    cubes, _ = blockVarsWithOrigin(blkId)
+    anchors = asarray(anchors).reshape(-1,3)
+    return anchors[:,None,:,None] + cubes[None,:,:,:]
+
+def fitMask(heightMap, sizeZ, blkId, anchors):
+    """Returns an anchors x variations boolean array telling whether
+       each variation of the block fits when placed at each anchor,
+       on a board whose column heights are given by the 2d array
+       heightMap : all its cubes must be within the board, and either
+       on the top of a column or on another cube of the block"""
+    _, below = blockVarsWithOrigin(blkId)
+    cells = blockCells(blkId, anchors)
+    x, y, z = cells[:,:,0,:], cells[:,:,1,:], cells[:,:,2,:]
+    sizeX, sizeY = heightMap.shape
+    inside = (x >= 0) & (x < sizeX) & (y >= 0) & (y < sizeY) & (z < sizeZ)
+    heights = heightMap[x.clip(0,sizeX-1), y.clip(0,sizeY-1)]
+    return (inside & (z >= heights) \
+            & ((z == heights) | below[None,:,:])).all(1)
+
 def blockVarToASCII(blkId, blkVarId, showOrigin=False):
     return blockToASCII(blocksVar[blkId][:,:,blkVarId], showOrigin=showOrigin)
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Opening book : the best replies to the first plies' positions,
+computed offline by the AIs and looked up instead of searching
+
+A book file is made of a header (see headerFormat), the sorted uint64
+keys of its positions, and then the (x,y,z,blkId,blkVarId) int8 record
+of each position's reply, in the same order (passing being recorded with
+a blkId of -1). It is memory-mapped and searched by bisection, so that
+loading a book reads nothing but its header.
+
+Positions are keyed by GameState.canonicalKey, so a book built with
+symmetric settings also answers for the symmetric positions.
+"""
+
+from numpy.core.numeric import array, zeros
+from numpy.core.numerictypes import uint64
+from numpy.core.memmap import memmap
+from numpy import dtype
+import os
+import random
+import struct
+
+from blokus3d.gamestate import GameState
+from blokus3d.block import blockVarTable
+from blokus3d.store import moveDtype
+from blokus3d.utils import randomFromList
+
+bookMagic = 'B3DBOOK\0'
+# Header : magic, format version, number of players, board size,
+# whether the keys are canonical, number of positions, and checksum
+# of the block variations, which give their meaning to the records
+headerFormat = '<8sIIBBBBII'
+headerSize = struct.calcsize(headerFormat)
+keyDtype = dtype('<u8')
+formatVersion = 2
+
+class OpeningBook(object):
+    """Read-only opening book of the given settings,
+       an empty one if path does not exist"""
+
+    def __init__(self, settings, path):
+        self.settings = settings
+        self.path = path
+        self.size = 0
+        if not os.path.exists(path):
+            return
+        with open(path,'rb') as f:
+            magic, version, nbPlayers, sizeX, sizeY, sizeZ, symmetric, self.size, \
+                variations = struct.unpack(headerFormat, f.read(headerSize))
+        assert magic == bookMagic and version == formatVersion, \
+               "%s is not an opening book" % path
+        assert nbPlayers == settings.nbPlayers \
+               and (sizeX,sizeY,sizeZ) == settings.boardSize \
+               and bool(symmetric) == settings.symmetric, \
+               "%s was built for other game settings" % path
+        assert variations == blockVarTable().checksum, \
+               "%s was built with other block variations" % path
+        if self.size > 0:
+            self.keys = memmap(path, dtype=keyDtype, mode='r', \
+                               offset=headerSize, shape=(self.size,))
+            self.replies = memmap(path, dtype=moveDtype, mode='r', \
+                                  offset=headerSize+self.size*keyDtype.itemsize, \
+                                  shape=(self.size,))
+
+    def __len__(self):
+        return self.size
+
+    def _find(self, key):
+        """Index of a key in the book, or None"""
+        if self.size == 0:
+            return None
+        i = int(self.keys.searchsorted(uint64(key)))
+        if i < self.size and int(self.keys[i]) == key:
+            return i
+        return None
+
+    def get(self, gs, default=None):
+        """The book move of a game state (None for passing), or default if
+           it is not in the book. Once a player passed, the hash does not
+           tell the whole state, so the book is only used before."""
+        if gs.firstToPass != None:
+            return default
+        key, sym = gs.canonicalKey()
+        i = self._find(key)
+        if i == None:
+            return default
+        move = recordToMove(self.settings, tuple(map(int, self.replies[i])))
+        return gs._mirrorMoves([move], sym)[0]
+
+    def items(self):
+        """(key, record) pairs of the book, sorted by key"""
+        if self.size == 0:
+            return []
+        return [(int(key), tuple(map(int, record))) \
+                for key, record in zip(self.keys, self.replies)]
+
+def moveToRecord(move):
+    if move == None:
+        return (0,0,0,-1,0)
+    coords, blkId, blkVarId = move
+    return (int(coords[0]), int(coords[1]), int(coords[2]), blkId, blkVarId)
+
+def recordToMove(settings, record):
+    x, y, z, blkId, blkVarId = record
+    if blkId == -1:
+        return None
+    table = settings.placements
+    return table.moves[table.moveIds[(blkId,blkVarId,x,y,z)]]
+
+def writeBook(settings, path, entries):
+    """Write a book from a dict of canonical keys to records,
+       replacing the file at once so readers never see half a book"""
+    keys = sorted(entries)
+    records = zeros(len(keys), dtype=moveDtype)
+    for i, key in enumerate(keys):
+        records[i] = entries[key]
+    tmpPath = path+'.tmp'
+    with open(tmpPath,'wb') as f:
+        f.write(struct.pack(headerFormat, bookMagic, formatVersion, \
+                            settings.nbPlayers, *(settings.boardSize \
+                            + (settings.symmetric, len(keys), \
+                               blockVarTable().checksum))))
+        f.write(array(keys, dtype=keyDtype).tostring())
+        f.write(records.tostring())
+    os.rename(tmpPath, path)
+
+def buildBook(settings, path, playerFun, maxPlies, nbGames, \
+              explore=0.2, saveEvery=10, verbose=False):
+    """Extend the book at path with the moves of playerFun in the
+       positions of the first maxPlies plies of nbGames games.
+       The games follow the book moves, except that a random legal move
+       is played with probability explore, to reach other positions.
+       The book is saved every saveEvery games, so it can be built in
+       several runs or interrupted."""
+    book = OpeningBook(settings, path)
+    entries = dict(book.items())
+    del book
+    for game in xrange(nbGames):
+        gs = GameState.initState(settings)
+        for ply in xrange(maxPlies):
+            if gs.isOver() or gs.firstToPass != None:
+                break
+            key, sym = gs.canonicalKey()
+            if key not in entries:
+                move = playerFun(gs)
+                # Records are kept in the canonical frame
+                entries[key] = moveToRecord(gs._mirrorMoves([move], sym)[0])
+                if verbose:
+                    print "Game %d ply %d : %d positions" \
+                          % (game+1, ply+1, len(entries))
+            else:
+                move = recordToMove(settings, entries[key])
+                move = gs._mirrorMoves([move], sym)[0]
+            if random.random() < explore:
+                move = randomFromList(gs.legalMoves())
+            gs.playMove(move)
+        if (game+1) % saveEvery == 0 or game+1 == nbGames:
+            writeBook(settings, path, entries)
+    return len(entries)
+
+# Returned by OpeningBook.get for the positions out of the book
+outOfBook = object()
+
+class BookPlayer(object):
+    """Decision function playing the book moves,
+       and asking playerFun once out of the book"""
+
+    def __init__(self, book, playerFun, verbose=False):
+        self.book = book
+        self.playerFun = playerFun
+        self.verbose = verbose
+
+    def __call__(self, gs):
+        move = self.book.get(gs, outOfBook)
+        if move is outOfBook:
+            return self.playerFun(gs)
+        if self.verbose:
+            print "Book move"
+        return move
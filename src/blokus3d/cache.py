@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Bounded caches
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache(object):
+    """Dictionary-like cache that evicts the least recently used entries
+       once it holds more than maxSize entries, or once the sum of the
+       entries' weights exceeds maxWeight (None means no limit).
+       A cache with maxSize=0 stores nothing, which disables it.
+       It can be shared between threads."""
+
+    def __init__(self, maxSize=None, maxWeight=None, weight=len):
+        self.maxSize = maxSize
+        self.maxWeight = maxWeight
+        self.weight = weight
+        self.entries = OrderedDict()
+        self.totalWeight = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Put it back as the most recently used
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.totalWeight -= self.weight(self.entries.pop(key))
+            self.entries[key] = value
+            self.totalWeight += self.weight(value)
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > 0 \
+              and ((self.maxSize != None and len(self.entries) > self.maxSize) \
+                   or (self.maxWeight != None and self.totalWeight > self.maxWeight)):
+            _, value = self.entries.popitem(last=False)
+            self.totalWeight -= self.weight(value)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        """Entries from the least to the most recently used"""
+        with self.lock:
+            return self.entries.items()
+
+    def update(self, items):
+        for key, value in items:
+            self[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalWeight = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'weight': self.totalWeight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': float(self.hits)/lookups if lookups > 0 else 0.}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
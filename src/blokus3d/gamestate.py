@@ -5,24 +5,46 @@ Module containing the logic of the game
 """
 
 from numpy.core import vstack
-from numpy.core.numeric import array, zeros, fromiter
-from numpy.core.numerictypes import int8, int16
-from matplotlib.pylab import flatten
-from itertools import ifilter, product
+from numpy.core.numeric import array
+from numpy.core.numerictypes import int16
+from itertools import product
+from time import time
 import copy as cp
-import os
-import pickle
 
-from blokus3d.utils import emptyIter, fold, unik
-from blokus3d.block import nbBlocks, adjacentCoords, containsCube, blocksVar,\
-    blockVarWithOrigin, argsortBlocks, blocks, includesCube
+from blokus3d import instrument
+from blokus3d.cache import LRUCache
+from blokus3d.store import LegalMovesStore, StoreFullError
+from blokus3d.bitboard import BitBoard, boardMasks, popcount
+from blokus3d.placement import placementTable
+from blokus3d.zobrist import zobristTable
+from blokus3d.symmetry import symmetryTable
+from blokus3d.block import nbBlocks, containsCube,\
+    includesCube, fitMask, blockPenalties
 
 class GameSettings(object):
 
-    def __init__(self, nbPlayers):
+    def __init__(self, nbPlayers, symmetric=False):
         self.nbPlayers = nbPlayers
         self.boardSize = (5, 4, 2*nbPlayers if nbPlayers < 4 else 8)
         self.xycoords = list(product(xrange(self.boardSize[0]),xrange(self.boardSize[1])))
+        # Whether the legal moves caches are shared by symmetric states
+        self.symmetric = symmetric
+
+    @property
+    def placements(self):
+        """Table of all the placements of the blocks on the board,
+           shared by the settings having the same board size"""
+        return placementTable(self.boardSize)
+
+    @property
+    def zobrist(self):
+        """Zobrist keys used to hash the game states"""
+        return zobristTable(self.boardSize, self.nbPlayers)
+
+    @property
+    def symmetries(self):
+        """Symmetries of the board"""
+        return symmetryTable(self.boardSize)
 
 class GameState(object):
 
@@ -33,9 +55,35 @@ class GameState(object):
         assert len(playerBlocks)==self.nbPlayers
         self.settings = settings
         self.playerBlocks = playerBlocks
-        self.board = board
+        # The board is stored as bitmasks, but may be given as
+        # a list-of-lists-of-lists of player ids
+        self.bits = board if isinstance(board, BitBoard) \
+                    else BitBoard.fromLists(self.boardSize, self.nbPlayers, board)
         self.nextPlayer = nextPlayer # next player to play
         self.firstToPass = firstToPass
+        # hashes[p] is the Zobrist hash of the state if p were the next
+        # player, so that it can be updated without knowing who will play
+        self.hashes = settings.zobrist.hashes(self.bits.occupancy, playerBlocks)
+        # With symmetric settings, symHashes[s-1] are the hashes of
+        # the image of the state by the sth symmetry of the board
+        self.symHashes = None
+        if settings.symmetric:
+            sym = settings.symmetries
+            self.symHashes = [settings.zobrist.hashes( \
+                                  [sym.mirrorMask(occ, s) for occ in self.bits.occupancy], \
+                                  [sym.mirrorBlocks(blkIds, s) for blkIds in playerBlocks]) \
+                              for s in xrange(1, len(sym.symmetries))]
+        # Empty cubes next to or above each player's cubes
+        self.frontier = [self.bits.liberties([player]) \
+                         for player in xrange(self.nbPlayers)]
+        # Number of columns topped by each player, and penalty
+        # of each player's remaining blocks
+        self.topCounts = self.bits.topCounts()
+        self.penalties = [sum(blockPenalties[blkId] for blkId in blkIds) \
+                          for blkIds in playerBlocks]
+        # What is needed to undo each move played so far
+        # (a clone starts with an empty stack)
+        self.moveStack = []
 
     @classmethod
     def initState(cls, settings):
@@ -50,31 +98,43 @@ class GameState(object):
     def initBoard(cls, boardSize):
         return [[[] for _ in xrange(boardSize[1])] for _ in xrange(boardSize[0])]
 
+    @property
+    def board(self):
+        """The board as a list-of-lists-of-lists of player ids
+           (a copy, modifying it has no effect on the game state)"""
+        return self.bits.toLists()
+
     def __uniqueid__(self):
-        # Create an order of players such that
-        # the nextPlayer is 0
-        order = fromiter((player % self.nbPlayers \
-                    for player in xrange(self.nextPlayer, self.nextPlayer+4)),\
-                    dtype=int8)
-        remainingBlocks = sum( \
-            (p*(2**nbBlocks) \
-             + sum(2**b for b in self.playerBlocks[p])) \
-            for p in order)
-        board = tuple(tuple(tuple(order[h] for h in c)\
-                    for c in l) for l in self.board)
-        return (remainingBlocks, board)
+        """64-bit hash of the board and remaining blocks,
+           with the players numbered from the next one"""
+        return self.hashes[self.nextPlayer]
+
+    def canonicalKey(self):
+        """Hash shared by the state and its images by the symmetries of
+           the board (with symmetric settings, else it is __uniqueid__),
+           and the symmetry mapping the state to the one with this hash"""
+        key, sym = self.hashes[self.nextPlayer], 0
+        if self.symHashes != None:
+            for s, hashes in enumerate(self.symHashes, 1):
+                if hashes[self.nextPlayer] < key:
+                    key, sym = hashes[self.nextPlayer], s
+        return key, sym
 
     def height(self,xy):
         assert len(xy)==2
         assert xy[0]>=0 and xy[0] < self.boardSize[0]
         assert xy[1]>=0 and xy[1] < self.boardSize[1]
-        return len(self.board[xy[0]][xy[1]])
+        return self.bits.heights[xy[0]*self.boardSize[1]+xy[1]]
 
     def heightMap(self):
         return tuple(tuple(self.height([x,y]) \
                 for y in xrange(self.boardSize[1])) \
                 for x in xrange(self.boardSize[0]))
 
+    def heightArray(self):
+        """Height map as a 2d array"""
+        return array(self.bits.heights).reshape(self.boardSize[:2])
+
     def emptyCoords(self,coords):
         """Returns True iff the coordinates are within the board
            and empty of any cube"""
@@ -85,38 +145,21 @@ class GameState(object):
 
     def adjToPlayers(self,players):
         """Returns the coordinates of grounded (not floating)
-           empty cubes adjacent to given players' cubes"""
-        # Get liberty cubes
-        L = self.libertyCubes(players)
-        if L==[]:
-            return L
-        # Remove all the "floating" cubes
-        # XXX maybe there's a cleaner way, using an iterator ?
-        L.reverse()
-        x, y, z = L[-1][0], L[-1][1], L[-1][2]
-        newL = [ L.pop() ]
-        while len(L) > 0:
-            e = L.pop()
-            if x==e[0] and y==e[1]:
-                assert e[2] > z
-            else:
-                newL.append(e)
-                x, y, z = e[0], e[1], e[2]
-        return newL
+           empty cubes adjacent to given players' cubes, as a n*3 array"""
+        return self.bits.coordsArray(self.libertiesMask(players) \
+                                     & self.bits.surface())
 
     def libertyCubes(self,players):
         """Return the coordinates of empty cubes
-           adjacent to given players' cubes"""
-        L = []
-        for (x,y) in self.xycoords:
-            for z in xrange(self.height([x,y])):
-                if self.board[x][y][z] in players:
-                    L.extend(filter(lambda coords : \
-                        self.emptyCoords(coords), \
-                        adjacentCoords+array([x,y,z])))
-        # remove duplicates
-        L = unik(L)
-        return L
+           adjacent to given players' cubes, as a n*3 array"""
+        return self.bits.coordsArray(self.libertiesMask(players))
+
+    def libertiesMask(self,players):
+        """Mask of the empty cubes adjacent to given players' cubes"""
+        mask = 0
+        for player in players:
+            mask |= self.frontier[player]
+        return mask
 
     def doesFit(self,blk,xyz):
         """Returns whether a block fits at a particular position
@@ -134,89 +177,108 @@ class GameState(object):
         return True
 
     def blockVarsThatFit(self,blkId,coords):
-        return filter(lambda i: self.doesFit(blocksVar[blkId][:,:,i],coords),\
-                      xrange(blocksVar[blkId].shape[2]))
+        return list(fitMask(self.heightArray(), self.boardSize[2], \
+                            blkId, coords)[0].nonzero()[0])
 
     def legalCubes(self):
-        alreadyPlayed = not emptyIter( \
-                            ifilter(lambda x : x == self.nextPlayer, \
-                            flatten(self.board)))
+        """Coordinates of the grounded cubes among which the
+           next player's block must cover at least one"""
+        return self.bits.coordsArray(self.allowedCubesMask() & self.bits.surface())
+
+    def allowedCubesMask(self):
+        """Mask of the cubes among which the next player's block
+           must cover at least one"""
         # Did the next player already played ?
-        if alreadyPlayed:
-            return self.adjToPlayers([self.nextPlayer])
+        if self.bits.occupancy[self.nextPlayer] != 0:
+            return self.frontier[self.nextPlayer]
         # Did someone else played ?
-        elif not emptyIter(ifilter(lambda x: x != [],flatten(self.board))):
-            # Get the cubes adjacent to any player
-            return self.adjToPlayers(range(self.nbPlayers))
-        # Else, all floor cubes are legal
+        elif self.bits.occupied() != 0:
+            mask = 0
+            for liberties in self.frontier:
+                mask |= liberties
+            return mask
+        # Else, all floor cubes are allowed
         else:
-            return vstack([array([x,y,0]) for (x,y) in self.xycoords])
+            return boardMasks(self.boardSize).floor
+
+    def fittingPlacements(self):
+        """Yields the ids of the next player's placements (in the
+           settings' placement table) that lie on the board"""
+        return self.settings.placements.fittingPlacements( \
+                    self.bits.heights, self.playerBlocks[self.nextPlayer])
+
+    def legalPlacements(self):
+        """Returns the ids of the placements (in the settings'
+           placement table) that are legal for the next player"""
+        masks = self.settings.placements.masks
+        allowedMask = self.allowedCubesMask()
+        return [pid for pid in self.fittingPlacements() \
+                if masks[pid] & allowedMask]
 
     def legalMoves(self):
-        uid = self.__uniqueid__()
-        if legalMovesDic.has_key(uid):
-            return legalMovesDic[uid]
-        lc = self.legalCubes()
-        L = []
-        #duplicates = 0
-        for blkId in self.playerBlocks[self.nextPlayer]:
-            # Find all the variations that fit
-            # and make coords-blkVarId couple
-            coordsBlkVarIds = fold(list.__add__, [[(coords,blkVarId) \
-                for blkVarId in self.blockVarsThatFit(blkId,coords)]
-                for coords in lc])
-            # If there are some
-            if coordsBlkVarIds != [] and coordsBlkVarIds != None:
-                # We will eliminate duplicates
-                # For each coords-blkVarId pair, get the cube
-                # coordinates on the board
-                M = map(lambda (coords,blkVarId): \
-                    coords+blockVarWithOrigin(blkId,blkVarId), coordsBlkVarIds)
-                N = iter(argsortBlocks(M))
-                lastOne = next(N)
-                # Add the first coords-blkVarId variation to the big list
-                L.append((coordsBlkVarIds[lastOne][0],\
-                          blkId,coordsBlkVarIds[lastOne][1]))
-                # Go though all the coords-blkVarId variations
-                try:
-                    while True:
-                        nextToLastOne = next(N)
-                        # If next one is not the same
-                        if not (M[lastOne]==M[nextToLastOne]).all():
-                            # Add the next on to the big list
-                            L.append((coordsBlkVarIds[nextToLastOne][0],\
-                                      blkId,coordsBlkVarIds[nextToLastOne][1]))
-                        #else:
-                        #    duplicates += 1
-                        lastOne = nextToLastOne
-                except StopIteration:
-                    pass
-        #print "%d duplicates" % duplicates
+        # The caches hold the moves of the canonical state,
+        # which are mapped back by the same symmetry
+        uid, sym = self.canonicalKey()
+        L = legalMovesCache.get(uid)
+        if L != None:
+            if instrument.enabled:
+                instrument.count('legalMoves.cacheHits')
+            return self._mirrorMoves(L, sym)
+        table = self.settings.placements
+        if legalMovesStore != None:
+            records = legalMovesStore.get(uid)
+            if records == [None]:
+                L = records
+            elif records != None:
+                L = [table.moves[table.moveIds[(blkId,blkVarId,x,y,z)]] \
+                     for (x,y,z,blkId,blkVarId) in records]
+            if L != None:
+                if instrument.enabled:
+                    instrument.count('legalMoves.storeHits')
+                legalMovesCache[uid] = L
+                return self._mirrorMoves(L, sym)
+        if instrument.enabled:
+            instrument.count('legalMoves.misses')
+            start = time()
+        pids = self.legalPlacements()
+        if instrument.enabled:
+            instrument.addTime('legalMoves.generate', time()-start)
+        L = [table.moves[pid] for pid in pids]
         if L == []:
             L = [None]
-        # Add it to the dictionary
-        legalMovesDic[uid] = L
+            canonical = L
+        elif sym == 0:
+            canonical = L
+        else:
+            placements = self.settings.symmetries.placements[sym]
+            canonical = [table.moves[placements[pid]] for pid in pids]
+        # Add it to the caches
+        legalMovesCache[uid] = canonical
+        if legalMovesStore != None:
+            storeLegalMoves(uid, canonical)
         return L
 
+    def _mirrorMoves(self, moves, sym):
+        """Images of moves by the sth symmetry of the board"""
+        if sym == 0 or moves == [None]:
+            return moves
+        table = self.settings.placements
+        placements = self.settings.symmetries.placements[sym]
+        return [table.moves[placements[table.placementId(move)]] for move in moves]
+
     def legalMovesAsTuple(self):
         """For using UCT"""
         return [(coords[0],coords[1],coords[2],blkId,blkVarId) \
                 for coords,blkId,blkVarId in self.legalMoves()]
 
     def baseScores(self):
-        s = zeros(self.nbPlayers,dtype=int16)
-        for (x,y) in self.xycoords:
-            if self.height([x,y])>0:
-                s[self.board[x][y][-1]] += 1
-        return s
+        return array(self.topCounts,dtype=int16)
 
     def penalty(self):
-        return list(sum(map(lambda x : blocks[x].shape[0], \
-                        self.playerBlocks[player])) \
-                    for player in xrange(self.nbPlayers))
+        return list(self.penalties)
 
     def finalScores(self):
-        return self.baseScores() - self.penalty()
+        return self.baseScores() - self.penalties
 
     def isOver(self):
         return self.firstToPass == self.nextPlayer
@@ -226,39 +288,118 @@ class GameState(object):
         coords,blkId,blkVarId = move
         assert len(coords)==3
         assert blkId in self.playerBlocks[self.nextPlayer]
-        assert self.doesFit(blocksVar[blkId][:,:,blkVarId],coords)
+        assert fitMask(self.heightArray(), self.boardSize[2], \
+                       blkId, coords)[0,blkVarId]
         return True
 
     def playMove(self,move):
         assert move == None or (len(move) == 3 and move[0].shape == (3,))
+        if move == None or self.isOver():
+            return self.playPlacement(None)
+        assert self.assertValidMove(move)
+        return self.playPlacement(self.settings.placements.placementId(move))
+
+    def playPlacement(self,pid):
+        """Same as playMove, given the id of the placement
+           in the settings' placement table (None for passing)"""
         if self.firstToPass == self.nextPlayer:
             # Game is over !
+            self.moveStack.append(None)
             return self
-        if move == None:
+        if pid == None:
+            self.moveStack.append((None, None, self.firstToPass, None))
             if self.firstToPass == None:
                 self.firstToPass = self.nextPlayer
         else:
-            assert self.assertValidMove(move)
-            coords,blkId,blkVarId = move
+            table = self.settings.placements
             # Remove the block from the player's stock
-            self.playerBlocks[self.nextPlayer].remove(blkId)
-            blkWithOrigin = blockVarWithOrigin(blkId,blkVarId)
+            blkIdx = self.playerBlocks[self.nextPlayer].index(table.blkIds[pid])
+            del self.playerBlocks[self.nextPlayer][blkIdx]
+            self.penalties[self.nextPlayer] -= blockPenalties[table.blkIds[pid]]
             # Place the block on the board
-            for cube in blkWithOrigin:
-                assert cube[2]+coords[2]==self.height([cube[0]+coords[0],cube[1]+coords[1]])
-                self.board[cube[0]+coords[0]][cube[1]+coords[1]].append(self.nextPlayer)
+            self.bits.placeBlock(table.masks[pid], self.nextPlayer, table.tops[pid])
+            self._updateTopCounts(pid, 1)
+            self.moveStack.append((pid, blkIdx, self.firstToPass, list(self.frontier)))
+            self._updateHashes(pid)
+            self._updateFrontier(table.masks[pid])
             # Break the "passing chain", if necessary
             self.firstToPass = None
         # Update the next player
         self.nextPlayer = (self.nextPlayer+1) % self.nbPlayers
         return self
 
+    def undoMove(self):
+        """Take back the last move played on this
+           game state (or on the state it was cloned from)"""
+        record = self.moveStack.pop()
+        if record == None:
+            # The game was already over
+            return self
+        pid, blkIdx, self.firstToPass, frontier = record
+        self.nextPlayer = (self.nextPlayer-1) % self.nbPlayers
+        if pid != None:
+            table = self.settings.placements
+            self.bits.removeBlock(table.masks[pid], self.nextPlayer, \
+                                  table.footprints[pid])
+            self._updateTopCounts(pid, -1)
+            self.playerBlocks[self.nextPlayer].insert(blkIdx, table.blkIds[pid])
+            self.penalties[self.nextPlayer] += blockPenalties[table.blkIds[pid]]
+            self._updateHashes(pid)
+            self.frontier = frontier
+        return self
+
+    def _updateHashes(self, pid):
+        """Add or remove (both being a xor) a placement
+           of the next player to the hashes"""
+        self._xorPlacement(self.hashes, pid)
+        if self.symHashes != None:
+            placements = self.settings.symmetries.placements
+            for s, hashes in enumerate(self.symHashes, 1):
+                self._xorPlacement(hashes, placements[s][pid])
+
+    def _xorPlacement(self, hashes, pid):
+        zobrist = self.settings.zobrist
+        placementKeys = zobrist.placementKeys(self.settings.placements)[pid]
+        blkId = self.settings.placements.blkIds[pid]
+        n = self.nbPlayers
+        for nextPlayer in xrange(n):
+            k = (self.nextPlayer-nextPlayer) % n
+            hashes[nextPlayer] ^= placementKeys[k] ^ zobrist.blocks[k][blkId]
+
+    def _updateTopCounts(self, pid, sign):
+        """Give (sign 1) or take back (sign -1) to the next player the
+           tops of the columns covered by a placement"""
+        table = self.settings.placements
+        support = table.supports[pid]
+        if support != 0:
+            for player, occupancy in enumerate(self.bits.occupancy):
+                self.topCounts[player] -= sign*popcount(occupancy & support)
+        self.topCounts[self.nextPlayer] += sign*len(table.footprints[pid])
+
+    def _updateFrontier(self, mask):
+        """Update the frontiers after the next player
+           has placed the cubes of mask"""
+        for player in xrange(self.nbPlayers):
+            self.frontier[player] &= ~mask
+        self.frontier[self.nextPlayer] |= \
+            boardMasks(self.boardSize).neighbours(mask) & ~self.bits.occupied()
+
     def clone(self):
-        return GameState(self.settings,\
-                         list(map(cp.copy,self.playerBlocks)),\
-                         cp.deepcopy(self.board),\
-                         nextPlayer=self.nextPlayer,\
-                         firstToPass=self.firstToPass)
+        # Copy the mutable attributes, rather than
+        # computing the hashes and frontiers again
+        if instrument.enabled:
+            instrument.count('clones')
+        gs = cp.copy(self)
+        gs.playerBlocks = list(map(cp.copy,self.playerBlocks))
+        gs.bits = self.bits.clone()
+        gs.hashes = list(self.hashes)
+        if self.symHashes != None:
+            gs.symHashes = map(list, self.symHashes)
+        gs.frontier = list(self.frontier)
+        gs.topCounts = list(self.topCounts)
+        gs.penalties = list(self.penalties)
+        gs.moveStack = []
+        return gs
 
     def boardToASCII(self, markedCubes=None, zRange=None):
         if zRange == None:
@@ -271,7 +412,7 @@ class GameState(object):
                 for x in xrange(self.boardSize[0]):
                     s += "x" if includesCube(markedCubes,array([x,y,z]))\
                              else ("." if self.height([x,y]) <= z \
-                                       else chr(self.board[x][y][z]+65))
+                                       else chr(self.bits.owner(x,y,z)+65))
                 s += "\n"
             s += "\n"
         return s
@@ -341,18 +482,51 @@ class GameState(object):
         with open(filename,'r') as f:
             return cls.fromASCII(f.read())
 
-def loadLegalMovesDic():
-    """ Save/load the legal moves cache """
-    with open('legalMovesDic.dat','r') as f:
-        return pickle.load(f)
-
-if 'legalMovesDic.dat' in os.listdir('.'):
-    legalMovesDic = loadLegalMovesDic()
-else:
-    legalMovesDic = {}
-
-def saveLegalMovesDic():
-    print "Saving moves cache..."
-    with open('legalMovesDic.dat','w') as f:
-        pickle.dump(legalMovesDic,f)
-    print "...done"
+# Default size of the legal moves cache, in number of moves
+legalMovesCacheWeight = 2000000
+
+legalMovesCache = LRUCache(maxWeight=legalMovesCacheWeight)
+
+def setLegalMovesCache(cache):
+    """Replace the legal moves cache (e.g., LRUCache(maxSize=0)
+       to disable it), returning the previous one"""
+    global legalMovesCache
+    previous, legalMovesCache = legalMovesCache, cache
+    return previous
+
+def getLegalMovesCache():
+    return legalMovesCache
+
+# Optional on-disk store of legal moves, shared between processes
+legalMovesStore = None
+
+def openLegalMovesStore(path, readOnly=False):
+    """Use the legal moves store at path (created if needed)
+       behind the legal moves cache"""
+    global legalMovesStore
+    closeLegalMovesStore()
+    legalMovesStore = LegalMovesStore(path, readOnly=readOnly)
+    return legalMovesStore
+
+def closeLegalMovesStore():
+    global legalMovesStore
+    if legalMovesStore != None:
+        legalMovesStore.close()
+        legalMovesStore = None
+
+def storeLegalMoves(uid, moves):
+    """Append the legal moves of a state to the store, if it accepts them"""
+    if legalMovesStore.readOnly:
+        return
+    records = [] if moves == [None] else \
+              [(int(coords[0]),int(coords[1]),int(coords[2]),blkId,blkVarId) \
+               for (coords,blkId,blkVarId) in moves]
+    try:
+        legalMovesStore.put(uid, records)
+    except StoreFullError:
+        print "Legal moves store is full, it is now used read-only"
+        legalMovesStore.readOnly = True
+
+def flushLegalMovesStore():
+    if legalMovesStore != None:
+        legalMovesStore.flush()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Opt-in counters and timers of the hot paths
+
+The hooks in the other modules are guarded by a test of enabled, so
+that they cost one global lookup when instrumentation is off :
+
+    if instrument.enabled:
+        instrument.count('clones')
+
+Counters and timers are per process : what happens in the processes
+forked by the anytime searches or the tournaments is not counted.
+"""
+
+from collections import defaultdict
+
+enabled = False
+counters = defaultdict(int)
+timers = defaultdict(float)
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def disable():
+    enable(False)
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+def count(name, n=1):
+    counters[name] += n
+
+def addTime(name, seconds):
+    timers[name] += seconds
+
+def snapshot():
+    """Record of the counters and timers, as plain dicts"""
+    return {'counters': dict(counters), 'timers': dict(timers)}
+
+def _ratio(a, b):
+    return float(a)/b if b != 0 else 0.
+
+def report(record):
+    """Human readable report of a record made by snapshot"""
+    c, t = record['counters'], record['timers']
+    lines = ["%-28s %d" % (name, value) for name, value in sorted(c.iteritems())]
+    lines += ["%-28s %.4f s" % (name, value) for name, value in sorted(t.iteritems())]
+    lookups = sum(c.get('legalMoves.'+kind, 0) \
+                  for kind in ('cacheHits', 'storeHits', 'misses'))
+    if lookups > 0:
+        lines.append("%-28s %.1f%%" % ('legalMoves hit rate', \
+                     100.*(lookups-c.get('legalMoves.misses', 0))/lookups))
+    if c.get('playouts', 0) > 0:
+        lines.append("%-28s %.1f" % ('mean playout depth', \
+                     _ratio(c.get('playout.moves', 0), c['playouts'])))
+    return '\n'.join(lines)
@@ -6,7 +6,6 @@
 from numpy.core.numeric import array
 from numpy.core.fromnumeric import sort
 from numpy.lib.arraysetops import unique
-from matplotlib.pylab import flatten
 from blokus3d.block import blockToASCII, blockVarToASCII, \
                            blockNames, blocks, blocksVar
 from blokus3d.move import moveToASCII
@@ -63,7 +62,7 @@ def findCoords(gs, candidates=None):
         candidates=[]
         # List all the possible z-level (heights)
         zRange = list(takewhile(lambda x : x < gs.boardSize[2], \
-                 sort(unique(flatten(gs.heightMap())))))
+                 sort(unique(gs.heightArray()))))
         if zRange==[]:
             print "Board is full, cannot find legal coordinates !"
             return None
@@ -2,11 +2,21 @@
 #-*- coding:utf-8 -*-
 
 from numpy.core import mean
-from numpy.core.numeric import array
-from matplotlib.pylab import find
-from itertools import cycle
+from numpy.core.numeric import array, argsort, flatnonzero
+from numpy.core.umath import log10, sqrt
+from itertools import cycle, permutations
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
+from time import time
+import traceback
+import random
+import numpy.random
+import json
+import os
 
-from blokus3d.gamestate import saveLegalMovesDic, GameState
+from blokus3d import instrument
+from blokus3d.gamestate import flushLegalMovesStore, setLegalMovesCache, \
+    getLegalMovesCache, GameState
 
 def scoresStats(scoresList):
     scoresList = array(scoresList)
@@ -14,8 +24,8 @@ def scoresStats(scoresList):
     print "Player | wins loses (ties) meanWinMargin meanLossMargin"
     for player in xrange(nbPlayers):
         otherPlayer = (player+1) % nbPlayers
-        winning = find(scoresList[:,player] > scoresList[:,otherPlayer])
-        losing  = find(scoresList[:,player] < scoresList[:,otherPlayer])
+        winning = flatnonzero(scoresList[:,player] > scoresList[:,otherPlayer])
+        losing  = flatnonzero(scoresList[:,player] < scoresList[:,otherPlayer])
         wins,loses = len(winning),len(losing)
         ties = scoresList.shape[0]-wins-loses
         meanWinningMargin = mean(sum(scoresList[winning],1))
@@ -25,54 +35,219 @@ def scoresStats(scoresList):
              meanWinningMargin, meanLosingMargin)
 
 def match(settings, playersFun, verbose=False, askConfirmation=False, recordUnder=None,\
-          startFrom=None, saveCache=True, stopAfterTurn=None):
+          startFrom=None, saveCache=True, stopAfterTurn=None, legalMovesCache=None,\
+          instrumentRecords=None):
     """Make matches between human or artificial players
-       using decision functions. Returns the final score."""
+       using decision functions. Returns the final score.
+       A legal moves cache may be given to be used during the match
+       instead of the shared one. When saveCache is set, the legal
+       moves store (if any) is flushed at the end.
+       When instrumentation is enabled (see the instrument module), the
+       counters and timers of each decision are printed in verbose mode,
+       and appended to instrumentRecords if it is a list."""
     assert len(playersFun) == settings.nbPlayers
     gs = startFrom if startFrom != None else GameState.initState(settings)
-    if recordUnder != None:
+    if legalMovesCache != None:
+        previousCache = setLegalMovesCache(legalMovesCache)
+    try:
         turn = 1
-    while not gs.isOver():
-        if verbose:
-            print "Player %c turn" % chr(65+gs.nextPlayer)
-        gs.playMove(playersFun[gs.nextPlayer](gs))
-        if recordUnder != None:
-            gs.save(recordUnder+str(turn))
+        while not gs.isOver():
+            if verbose:
+                print "Player %c turn" % chr(65+gs.nextPlayer)
+            if instrument.enabled:
+                instrument.reset()
+                player, start = gs.nextPlayer, time()
+            gs.playMove(playersFun[gs.nextPlayer](gs))
+            if instrument.enabled:
+                record = instrument.snapshot()
+                record.update(turn=turn, player=player, seconds=time()-start)
+                if verbose:
+                    print instrument.report(record)
+                if instrumentRecords != None:
+                    instrumentRecords.append(record)
+            if recordUnder != None:
+                gs.save(recordUnder+str(turn))
             turn += 1
-        if saveCache:
-            saveLegalMovesDic()
+            if verbose:
+                print gs
+            if askConfirmation:
+                raw_input("Press ENTER to continue")
+            if verbose:
+                print '-'*60
+            if stopAfterTurn:
+                if turn > stopAfterTurn:
+                    print "Stopping after turn %d" % (turn-1)
+                    break
         if verbose:
-            print gs
-        if askConfirmation:
-            raw_input("Press ENTER to continue")
-        if verbose:
-            print '-'*60
-        if stopAfterTurn:
-            if turn > stopAfterTurn:
-                print "Stopping after turn %d" % (turn-1)
-                return gs
+            print "Legal moves cache :", getLegalMovesCache().stats()
+        if saveCache:
+            flushLegalMovesStore()
+    finally:
+        if legalMovesCache != None:
+            setLegalMovesCache(previousCache)
     return gs
 
+def seatOrders(nbPlayers):
+    """Every order in which the players can be seated,
+       order[seat] being the player at this seat"""
+    return list(permutations(xrange(nbPlayers)))
+
+def playSeated(settings, playersFun, order):
+    """Final scores of a match where the players are seated according
+       to order, given in the players' order (not the seats')"""
+    gs = match(settings, map(playersFun.__getitem__, order), saveCache=False)
+    return gs.finalScores()[argsort(order)]
+
 def competitor(settings, playersFun):
     """A generator that make matches between players, cycling through
-       the possible order so it makes the evaluation fair"""
+       the possible orders so it makes the evaluation fair"""
     assert len(playersFun) == settings.nbPlayers
-    if len(playersFun) != 2:
-        print "Only works for 2 players right now !!!"
-        raise StopIteration
-    # We will cycle through the possible order of players
-    # TODO generate that for any player number
-    orderGen = cycle([[0,1],[1,0]])
-    while True:
-        order = next(orderGen)
-        yield match(settings, map(playersFun.__getitem__, order), saveCache=False).finalScores()[order]
+    for order in cycle(seatOrders(settings.nbPlayers)):
+        yield playSeated(settings, playersFun, order)
+
+# Players of the tournament being run, inherited by the forked
+# workers, as decision functions (often lambdas) cannot be pickled
+_tournamentPlayers = None
+
+def _tournamentWorker(settings, tasks, results):
+    """Play the matches read from tasks until getting None"""
+    for matchId, order, seed in iter(tasks.get, None):
+        results.put({'started': matchId, 'pid': os.getpid()})
+        # Forked workers inherit the same random states
+        random.seed(seed)
+        numpy.random.seed(seed % 2**32)
+        start = time()
+        try:
+            scores = playSeated(settings, _tournamentPlayers, order)
+        except Exception:
+            results.put({'match': matchId, 'error': traceback.format_exc()})
+            continue
+        results.put({'match': matchId, 'order': list(order), 'seed': seed, \
+                     'scores': map(int, scores), 'seconds': time()-start})
+
+def tournament(settings, playersFun, nbMatches, nbProcesses=None, \
+               resultsPath=None, seed=0, verbose=False, pollSeconds=1.):
+    """Play nbMatches matches between the players on nbProcesses
+       processes (all the CPUs by default), rotating through all the
+       seat orders. Returns the results as dicts holding the players'
+       scores (in the players' order), the seat order, the random seed
+       of the match and its duration. They are also appended to the
+       JSON-lines file resultsPath (if given) as soon as they arrive, so
+       that an interrupted tournament is not lost (see readResults).
+       Every pollSeconds without news, the workers are checked : if one
+       of them died in the middle of a match, a RuntimeError is raised
+       rather than waiting for it forever."""
+    global _tournamentPlayers
+    assert len(playersFun) == settings.nbPlayers
+    if nbProcesses == None:
+        nbProcesses = cpu_count()
+    orders = seatOrders(settings.nbPlayers)
+    tasks, results = Queue(), Queue()
+    for matchId in xrange(nbMatches):
+        tasks.put((matchId, orders[matchId % len(orders)], seed+matchId))
+    for _ in xrange(nbProcesses):
+        tasks.put(None)
+    _tournamentPlayers = playersFun
+    # Not daemonic, as players may start processes of their own
+    workers = [Process(target=_tournamentWorker, args=(settings, tasks, results)) \
+               for _ in xrange(nbProcesses)]
+    for worker in workers:
+        worker.start()
+    byPid = dict((worker.pid, worker) for worker in workers)
+    running = {} # match id -> worker playing it
+    done = []
+    output = open(resultsPath, 'a') if resultsPath != None else None
+    def handle(result):
+        if 'started' in result:
+            running[result['started']] = byPid[result['pid']]
+            return
+        del running[result['match']]
+        if 'error' in result:
+            raise RuntimeError("Match %d failed :\n%s" \
+                               % (result['match'], result['error']))
+        done.append(result)
+        if output != None:
+            output.write(json.dumps(result)+'\n')
+            output.flush()
+        if verbose:
+            print "Match %d/%d result: %s" % (len(done), nbMatches, result['scores'])
+    try:
+        while len(done) < nbMatches:
+            try:
+                handle(results.get(timeout=pollSeconds))
+                continue
+            except Empty:
+                pass
+            if all(worker.is_alive() for worker in running.itervalues()) \
+               and any(worker.is_alive() for worker in workers):
+                continue
+            # What the dead workers sent before exiting may still be queued
+            try:
+                while True:
+                    handle(results.get_nowait())
+            except Empty:
+                pass
+            for matchId, worker in sorted(running.iteritems()):
+                if not worker.is_alive():
+                    raise RuntimeError("Match %d was lost : its worker exited " \
+                                       "with code %s" % (matchId, worker.exitcode))
+            if len(done) < nbMatches \
+               and not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("All the workers exited with %d matches left" \
+                                   % (nbMatches-len(done)))
+    finally:
+        if output != None:
+            output.close()
+        for worker in workers:
+            if len(done) < nbMatches:
+                worker.terminate()
+            worker.join()
+        _tournamentPlayers = None
+    return done
+
+def readResults(path):
+    """Results of a tournament, as written to resultsPath"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+def eloFromRate(rate):
+    """Elo difference matching an expected score"""
+    rate = min(max(rate, 1e-3), 1-1e-3)
+    return -400.*log10(1./rate-1.)
+
+def tournamentStats(results, nbPlayers, names=None):
+    """Prints and returns, for each player, the number of wins (first
+       places, shared in case of a tie), the mean score margin over the
+       best opponent, the rate of opponents beaten in a match (counting
+       ties as halves) and the matching Elo difference with the average
+       opponent, with 95% confidence intervals.
+       For two players, that rate is just the win rate."""
+    if names == None:
+        names = [chr(65+player) for player in xrange(nbPlayers)]
+    scores = array([result['scores'] for result in results], dtype=float)
+    nbMatches = scores.shape[0]
+    print "Player | wins margin rate [95%% CI] elo [95%% CI] (%d matches)" % nbMatches
+    stats = []
+    for player in xrange(nbPlayers):
+        others = scores[:, [p for p in xrange(nbPlayers) if p != player]]
+        own = scores[:, player:player+1]
+        best = others.max(1)
+        winners = (scores == scores.max(1)[:,None]).sum(1)
+        wins = (((own[:,0] >= best) * 1.) / winners).sum()
+        margin = (own[:,0]-best).mean()
+        rates = ((own > others) + .5*(own == others)).mean(1)
+        rate = rates.mean()
+        halfWidth = 1.96*rates.std(ddof=1)/sqrt(nbMatches) if nbMatches > 1 else 1.
+        low, high = max(0., rate-halfWidth), min(1., rate+halfWidth)
+        elo, eloLow, eloHigh = eloFromRate(rate), eloFromRate(low), eloFromRate(high)
+        print "%6s | %.1f %+.2f %.3f [%.3f,%.3f] %+.0f [%+.0f,%+.0f]" % \
+            (names[player], wins, margin, rate, low, high, elo, eloLow, eloHigh)
+        stats.append({'player': names[player], 'wins': wins, 'margin': margin, \
+                      'rate': (rate, low, high), 'elo': (elo, eloLow, eloHigh)})
+    return stats
 
-def runCompetition(settings, playersFun):
-    gen = competitor(settings, playersFun)
-    results = []
-    nbMatchs = 3
-    for i in xrange(nbMatchs):
-        res = next(gen)
-        print "Match %d/%d result: %s" % (i+1, nbMatchs, res)
-        results.append(res)
-    scoresStats(results)
+def runCompetition(settings, playersFun, nbMatches=100, nbProcesses=None, \
+                   resultsPath=None):
+    results = tournament(settings, playersFun, nbMatches, nbProcesses, \
+                         resultsPath, verbose=True)
+    return tournamentStats(results, settings.nbPlayers)
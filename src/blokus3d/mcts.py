@@ -1,4 +1,11 @@
 # Modified by Didier Marin.
+# The search now plays and takes back moves on a single game state,
+# uses the fast random playouts of the playout module, handles any
+# number of players, can run in parallel over several processes
+# (see parallelUCT), can share the statistics of the nodes
+# reaching the same state (see TranspositionUCT), and can keep
+# its tree from one turn to the next (see UCTPlayer).
+#
 # Original description :
 #
 # This is a very simple implementation of the UCT Monte Carlo Tree Search algorithm in Python 2.7.
@@ -18,52 +25,93 @@
 #
 # For more information about Monte Carlo Tree Search check out our web site at www.mcts.ai
 
-from numpy.core import hstack
+from numpy.core import hstack, vstack
 from math import sqrt, log
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from time import time
 import random
 
-from blokus3d.move import moveIndex
+from blokus3d import instrument
+from blokus3d.move import moveIndex, moveKey
+from blokus3d.cache import LRUCache
+from blokus3d.playout import playout, randomPlayouts
+from blokus3d.symmetry import pruneSymmetricMoves
+
+def stateKey(state):
+    """ Key identifying a game state in a tree or a transposition table """
+    return (state.__uniqueid__(), state.nextPlayer, state.firstToPass)
 
 class Node(object):
     """ A node in the game tree. Note wins is always from the viewpoint of playerJustMoved.
         Crashes if state not specified.
     """
+    __slots__ = ('move', 'parentNode', 'childNodes', 'wins', 'visits', \
+                 'untriedMoves', 'ownsUntriedMoves', 'playerJustMoved', 'stateKey')
+
     def __init__(self, gameSettings, move = None, parent = None, state = None):
-        self.gameSettings = gameSettings
         self.move = move # the move that got us to this node - "None" for the root node
         self.parentNode = parent # "None" for the root node
         self.childNodes = []
         self.wins = 0
         self.visits = 0
-        self.untriedMoves = state.legalMoves() # future child nodes
+        # future child nodes, shared with the legal moves cache
+        # until a move is removed from them
+        self.untriedMoves = state.legalMoves()
+        self.ownsUntriedMoves = False
         # the only part of the state that the Node needs later
         self.playerJustMoved = (state.nextPlayer-1) % gameSettings.nbPlayers
+        # to find the node of a state again, when reusing the tree
+        self.stateKey = stateKey(state)
 
     def UCTSelectChild(self):
         """ Use the UCB1 formula to select a child node. Often a constant UCTK is applied
             so we have lambda c: c.wins/c.visits + UCTK * sqrt(2*log(self.visits)/c.visits
             to vary the amount of exploration versus exploitation.
         """
-        key = lambda c: c.wins/c.visits + sqrt(2*log(self.visits)/c.visits)
-        s = sorted(self.childNodes, key = key)[-1]
-        return s
+        return self.childNodes[self.UCTSelectIndex()]
 
-    def AddChild(self, m, s):
-        """ Remove m from untriedMoves and add a new child node for this move.
+    def UCTSelectIndex(self):
+        """ Index of the child node selected by UCTSelectChild """
+        logVisits = 2*log(self.visits)
+        best, bestValue = None, None
+        for i, c in enumerate(self.childNodes):
+            value = float(c.wins)/c.visits + sqrt(logVisits/c.visits)
+            if best == None or value > bestValue:
+                best, bestValue = i, value
+        return best
+
+    def AddChild(self, m, s, i = None):
+        """ Remove m (found at index i, if given) from untriedMoves
+            and add a new child node for this move.
             Return the added child node
         """
-        n = Node(self.gameSettings, move = m, parent = self, state = s)
-        i = moveIndex(self.untriedMoves,m)
-        self.untriedMoves = self.untriedMoves[:i]+self.untriedMoves[i+1:]
+        n = Node(s.settings, move = m, parent = self, state = s)
+        if instrument.enabled:
+            instrument.count('uct.nodes')
+        self.RemoveUntriedMove(m, i)
         self.childNodes.append(n)
         return n
 
+    def RemoveUntriedMove(self, m, i = None):
+        """ Remove m (found at index i, if given) from untriedMoves """
+        if i == None:
+            i = moveIndex(self.untriedMoves,m)
+        if not self.ownsUntriedMoves:
+            self.untriedMoves = list(self.untriedMoves)
+            self.ownsUntriedMoves = True
+        # Replace m by the last move, as the order does not matter
+        last = self.untriedMoves.pop()
+        if i < len(self.untriedMoves):
+            self.untriedMoves[i] = last
+
     def Update(self, result):
         """ Update this node - one additional visit and result additional wins.
             result must be from the viewpoint of playerJustmoved.
         """
         self.visits += 1
-        self.wins += result
+        # scores are 16-bit integers, which the sum could overflow
+        self.wins += int(result)
 
     def __repr__(self):
         return "[M:" + str(self.move) + " W/V:" + str(self.wins) + "/" \
@@ -87,17 +135,56 @@ class Node(object):
             s += str(c) + "\n"
         return s
 
-def UCT(gameSettings, rootstate, itermax, verbose=False):
-    """ Conduct a UCT search for itermax iterations starting from rootstate.
-        Return the best move from the rootstate.
-        Assumes 2 alternating players (player 1 starts),
-        with game results in the range [0.0, 1.0]."""
+def SymmetricRootNode(gameSettings, rootstate, nodeClass=Node):
+    """ Root node whose untried moves only keep one move out of each set
+        of moves leading to symmetric states, as they lead to the same subtrees
+    """
+    rootnode = nodeClass(gameSettings, state = rootstate)
+    rootnode.untriedMoves = pruneSymmetricMoves(rootstate, rootnode.untriedMoves)
+    return rootnode
 
-    rootnode = Node(gameSettings, state = rootstate)
+def scoreDiff(scores, player):
+    """Score of a player minus the best score of his opponents"""
+    bestOpponentScore = max(hstack([scores[:player], scores[player+1:]]))
+    return scores[player] - bestOpponentScore
 
-    for _ in xrange(itermax):
+def scoreDiffs(scores):
+    """scoreDiff of every player, computed at once"""
+    scores = map(int, scores)
+    best = max(xrange(len(scores)), key = scores.__getitem__)
+    secondScore = max(scores[:best] + scores[best+1:])
+    return [score - (secondScore if player == best else scores[best]) \
+            for player, score in enumerate(scores)]
+
+def UCTSearch(gameSettings, rootstate, itermax, pool=None, leafPlayouts=None, \
+              rootnode=None, nbWorkers=None):
+    """ Conduct a UCT search for itermax iterations starting from rootstate,
+        and return the root node of the tree.
+        If a pool of processes is given, each leaf is evaluated with
+        leafPlayouts random playouts shared between the nbWorkers
+        workers of the pool (by default, one playout per worker).
+        The search can go on with the tree of a previous search, by giving
+        its node of rootstate (which must have no parent) as rootnode."""
+
+    if rootnode == None:
+        rootnode = SymmetricRootNode(gameSettings, rootstate)
+    for _ in islice(UCTIterations(gameSettings, rootstate, rootnode, \
+                                  pool, leafPlayouts, nbWorkers), itermax):
+        pass
+    return rootnode
+
+def UCTIterations(gameSettings, rootstate, rootnode, pool=None, leafPlayouts=None, \
+                  nbWorkers=None):
+    """ Generator conducting UCT iterations from rootstate, growing the tree
+        of rootnode, for as long as it is asked to. Yields rootnode after
+        each iteration. See UCTSearch for the other arguments."""
+
+    # The same state is used by all the iterations,
+    # taking back the moves played once they are done
+    state = rootstate.clone()
+
+    while True:
         node = rootnode
-        state = rootstate.clone()
 
         # Select
         # while node is fully expanded and non-terminal
@@ -108,31 +195,260 @@ def UCT(gameSettings, rootstate, itermax, verbose=False):
         # Expand
         # if we can expand (i.e. state/node is non-terminal)
         if node.untriedMoves != []:
-            m = random.choice(node.untriedMoves)
+            i = random.randrange(len(node.untriedMoves))
+            m = node.untriedMoves[i]
             state.playMove(m)
-            node = node.AddChild(m,state) # add child and descend tree
+            node = node.AddChild(m,state,i) # add child and descend tree
 
         # Rollout
-        # while state is non-terminal
-        while not state.isOver():
-            state.playMove(random.choice(state.legalMoves()))
+        # until state is terminal
+        if instrument.enabled:
+            instrument.count('uct.iterations')
+            start = time()
+        if pool == None:
+            playout(state)
+            results = [state.finalScores()]
+        else:
+            results = leafRollouts(pool, nbWorkers or leafPlayouts, \
+                                   state, leafPlayouts)
+        if instrument.enabled:
+            instrument.addTime('uct.rollout', time()-start)
 
         # Backpropagate
         # backpropagate from the expanded node and work back to the root node
+        results = map(scoreDiffs, results)
         while node != None:
-            scores = state.finalScores()
-            bestOpponentScore = max(hstack([scores[:node.playerJustMoved],\
-                                    scores[node.playerJustMoved+1:]]))
-            diffScore = scores[node.playerJustMoved] - bestOpponentScore
-            # state is terminal. Update node with result
-            # from POV of node.playerJustMoved
-            node.Update( diffScore )
+            # Update node with results from POV of node.playerJustMoved
+            for diffs in results:
+                node.Update(diffs[node.playerJustMoved])
             node = node.parentNode
 
+        # Go back to the root state
+        while state.moveStack != []:
+            state.undoMove()
+
+        yield rootnode
+
+def UCT(gameSettings, rootstate, itermax, verbose=False):
+    """ Conduct a UCT search for itermax iterations starting from rootstate.
+        Return the best move from the rootstate.
+        Works for any number of players, each node being credited with
+        the final score difference between the player who just moved
+        and his best opponent."""
+
+    rootnode = UCTSearch(gameSettings, rootstate, itermax)
+
     # Output some information about the tree - can be omitted
     if verbose:
         print rootnode.TreeToString(0)
         print rootnode.ChildrenToString()
 
     # return the move that was most visited
-    return sorted(rootnode.childNodes, key = lambda c: c.visits)[-1].move
+    return max(rootnode.childNodes, key = lambda c: c.visits).move
+
+def anytimeUCT(gameSettings, rootstate):
+    """ Generator conducting UCT iterations from rootstate, yielding
+        the most visited move after each of them (see the anytime module)."""
+    rootnode = SymmetricRootNode(gameSettings, rootstate)
+    for rootnode in UCTIterations(gameSettings, rootstate, rootnode):
+        yield max(rootnode.childNodes, key = lambda c: c.visits).move
+
+class UCTPlayer(object):
+    """ A UCT player that keeps its tree from one turn to the next.
+        After its move and the replies of the other players, the search
+        goes on from the node of the new state, if it was in the tree,
+        instead of starting over. Use one instance per seat and game."""
+
+    def __init__(self, gameSettings, itermax, verbose=False):
+        self.gameSettings = gameSettings
+        self.itermax = itermax
+        self.verbose = verbose
+        # node of the state following the last move chosen
+        self.lastNode = None
+
+    def findNode(self, gs):
+        """ Node of gs among the descendants of the last node,
+            or None if it cannot be found """
+        if self.lastNode == None:
+            return None
+        key = stateKey(gs)
+        # Every other player has made one move (or passed) since
+        nodes = [self.lastNode]
+        for _ in xrange(self.gameSettings.nbPlayers-1):
+            nodes = [c for n in nodes for c in n.childNodes]
+        for n in nodes:
+            if n.stateKey == key:
+                return n
+        return None
+
+    def __call__(self, gs):
+        rootnode = self.findNode(gs)
+        if rootnode != None:
+            # Forget the rest of the tree
+            rootnode.parentNode = None
+            rootnode.move = None
+        if self.verbose:
+            print "Reusing %d visits" % (rootnode.visits if rootnode != None else 0)
+        rootnode = UCTSearch(self.gameSettings, gs, self.itermax, rootnode=rootnode)
+        # keep the node of the move that was most visited
+        self.lastNode = max(rootnode.childNodes, key = lambda c: c.visits)
+        return self.lastNode.move
+
+    def reset(self):
+        """ Forget the tree, before starting a new game """
+        self.lastNode = None
+
+# Transposition-aware UCT
+
+class TranspositionNode(Node):
+    """ A node shared by all the paths leading to the same game state,
+        which turns the tree into a directed acyclic graph. As a node may
+        have several parents, each parent keeps the moves leading to its
+        children in childMoves, and parentNode is not used.
+    """
+    __slots__ = ('childMoves',)
+
+    def __init__(self, gameSettings, state):
+        Node.__init__(self, gameSettings, state = state)
+        self.childMoves = []
+        # Passing when the game is over leads to the same state,
+        # which would make a node its own child
+        if state.isOver():
+            self.untriedMoves = []
+
+    def AddEdge(self, m, child, i = None):
+        """ Remove m (found at index i, if given) from untriedMoves
+            and link this node to child through this move.
+        """
+        self.RemoveUntriedMove(m, i)
+        self.childNodes.append(child)
+        self.childMoves.append(m)
+
+def TranspositionUCTSearch(gameSettings, rootstate, itermax, tableSize=100000):
+    """ Same as UCTSearch, except that the nodes reaching the same game
+        state share their statistics, through a transposition table that
+        keeps at most tableSize nodes (the least recently used ones are
+        forgotten). Return the root node and the transposition table."""
+
+    table = LRUCache(maxSize=tableSize, weight=lambda node: 1)
+    rootnode = SymmetricRootNode(gameSettings, rootstate, TranspositionNode)
+    table[stateKey(rootstate)] = rootnode
+    state = rootstate.clone()
+
+    for _ in xrange(itermax):
+        node = rootnode
+        # A node may have several parents, so remember the way down
+        path = [rootnode]
+
+        # Select
+        while node.untriedMoves == [] and node.childNodes != []:
+            i = node.UCTSelectIndex()
+            state.playMove(node.childMoves[i])
+            node = node.childNodes[i]
+            path.append(node)
+
+        # Expand, linking to the known node of the new state if any
+        if node.untriedMoves != []:
+            i = random.randrange(len(node.untriedMoves))
+            m = node.untriedMoves[i]
+            state.playMove(m)
+            child = table.get(stateKey(state))
+            if child == None:
+                child = TranspositionNode(gameSettings, state)
+                table[child.stateKey] = child
+            node.AddEdge(m, child, i)
+            node = child
+            path.append(node)
+
+        # Rollout
+        playout(state)
+        diffs = scoreDiffs(state.finalScores())
+
+        # Backpropagate along the path
+        for node in path:
+            node.Update(diffs[node.playerJustMoved])
+
+        # Go back to the root state
+        while state.moveStack != []:
+            state.undoMove()
+
+    return rootnode, table
+
+def TranspositionUCT(gameSettings, rootstate, itermax, tableSize=100000, verbose=False):
+    """ Conduct a transposition-aware UCT search for itermax iterations
+        starting from rootstate. Return the best move from the rootstate."""
+
+    rootnode, table = TranspositionUCTSearch(gameSettings, rootstate, \
+                                             itermax, tableSize)
+
+    if verbose:
+        print "Transposition table :", table.stats()
+        print rootnode.ChildrenToString()
+
+    # return the move that was most visited
+    i = max(xrange(len(rootnode.childNodes)), \
+            key = lambda i: rootnode.childNodes[i].visits)
+    return rootnode.childMoves[i]
+
+# Parallel UCT
+
+def _rootWorker((gameSettings, rootstate, itermax, seed)):
+    """Grow a tree in a worker process, returning the
+       statistics of the root's children"""
+    random.seed(seed)
+    rootnode = UCTSearch(gameSettings, rootstate, itermax)
+    return [(c.move, c.visits, c.wins) for c in rootnode.childNodes]
+
+def _leafWorker((state, nbPlayouts, seed)):
+    return randomPlayouts(state, nbPlayouts, seed=seed)
+
+def leafRollouts(pool, nbWorkers, state, nbPlayouts):
+    """Final scores of nbPlayouts random playouts from state,
+       shared between the nbWorkers workers of the pool"""
+    tasks = [(state, nbPlayouts//nbWorkers + (1 if w < nbPlayouts % nbWorkers else 0), \
+              random.randrange(2**31)) for w in xrange(nbWorkers)]
+    return vstack([scores for scores in pool.map(_leafWorker, tasks) \
+                   if len(scores) > 0])
+
+def parallelUCT(gameSettings, rootstate, itermax, nbWorkers=None, \
+                leafParallel=False, pool=None, verbose=False):
+    """ Parallel version of UCT, using a pool of processes
+        with nbWorkers processes (all the CPUs by default), a new one
+        being created if none is given.
+        With root parallelization (the default), each worker grows its
+        own tree for itermax iterations, and the visits and wins of the
+        root's children are summed over the trees. With leaf
+        parallelization, a single tree is grown for itermax iterations,
+        each leaf being evaluated by one random playout per worker."""
+    if nbWorkers == None:
+        nbWorkers = cpu_count()
+    ownPool = pool == None
+    if ownPool:
+        pool = Pool(nbWorkers)
+    try:
+        if leafParallel:
+            rootnode = UCTSearch(gameSettings, rootstate, itermax, pool=pool, \
+                                 leafPlayouts=nbWorkers, nbWorkers=nbWorkers)
+            children = [(c.move, c.visits, c.wins) for c in rootnode.childNodes]
+        else:
+            tasks = [(gameSettings, rootstate, itermax, random.randrange(2**31)) \
+                     for _ in xrange(nbWorkers)]
+            children = [child for result in pool.map(_rootWorker, tasks) \
+                        for child in result]
+    finally:
+        if ownPool:
+            pool.close()
+            pool.join()
+    # Merge the statistics of the same moves
+    stats = {}
+    for move, visits, wins in children:
+        key = moveKey(move)
+        if key not in stats:
+            stats[key] = [move, 0, 0]
+        stats[key][1] += visits
+        stats[key][2] += wins
+    if verbose:
+        for move, visits, wins in sorted(stats.values(), key=lambda s: s[1]):
+            print "[M:%s W/V:%s/%d]" % (move, wins, visits)
+    # return the move that was most visited
+    return max(stats.values(), key=lambda s: s[1])[0]
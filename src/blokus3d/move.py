@@ -28,3 +28,10 @@ def moveIndex(lst,m):
         if (e == None and m == None) or (tuple(e[0]) == tuple(m[0]) and e[1]==m[1] and e[2]==m[2]):
             return i
     return None
+
+def moveKey(move):
+    """Hashable representation of a move"""
+    if move == None:
+        return None
+    coords, blkId, blkVarId = move
+    return (int(coords[0]),int(coords[1]),int(coords[2]),blkId,blkVarId)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Precomputed table of every placement of every block variation
+on the board, used to turn move generation into a table lookup
+"""
+
+from numpy.core.numeric import array, zeros
+from itertools import product, izip
+
+from blokus3d.block import nbBlocks, blockCells
+from blokus3d.bitboard import boardMasks, iterBits
+
+class PlacementTable(object):
+    """All the distinct in-bounds placements of the blocks on a board.
+
+    A placement is identified by an integer id (pid) and described by:
+    - moves[pid]     : a move (coords,blkId,blkVarId) that produces it
+    - blkIds[pid]    : the id of the block
+    - masks[pid]     : the bitmask of its cubes on the board
+    - footprints[pid]: tuple of (column, z) pairs giving, for each column
+                       covered by the block, the height this column must
+                       have for the block to lie on it without any gap
+    - tops[pid]      : tuple of (column, z) pairs giving the height of
+                       these columns once the block is placed
+    - supports[pid]  : the bitmask of the cubes it lies on, which are
+                       the top cubes of these columns before it is placed
+    Placements that cover the same cubes with the same block are merged,
+    so there is no need to eliminate duplicate moves afterwards.
+    """
+
+    def __init__(self, boardSize):
+        self.boardSize = boardSize
+        self.moves = []
+        self.blkIds = []
+        self.masks = []
+        self.footprints = []
+        self.tops = []
+        self.supports = []
+        # (blkId, blkVarId, x, y, z) -> pid
+        self.moveIds = {}
+        # byBase[blkId][(column,z)] lists the pids of the block whose
+        # footprint starts with this column/height pair
+        self.byBase = [{} for _ in xrange(nbBlocks)]
+        for blkId in xrange(nbBlocks):
+            self._addBlock(blkId)
+        self._cellArrays = None
+
+    def _addBlock(self, blkId):
+        sizeX, sizeY, sizeZ = self.boardSize
+        # Every cell of the board may be the origin of a block,
+        # so compute the cubes of all the variations at all the cells
+        anchors = array(list(product(xrange(sizeX),xrange(sizeY),xrange(sizeZ))))
+        cells = blockCells(blkId, anchors)
+        x, y, z = cells[:,:,0,:], cells[:,:,1,:], cells[:,:,2,:]
+        inside = ((x >= 0) & (x < sizeX) & (y >= 0) & (y < sizeY) \
+                  & (z >= 0) & (z < sizeZ)).all(1)
+        known = {} # mask -> pid
+        for blkVarId, a in izip(*inside.T.nonzero()):
+            blkVarId, coords = int(blkVarId), anchors[a]
+            pid = self._addPlacement(known, (coords,blkId,blkVarId), \
+                                     cells[a,:,:,blkVarId].tolist())
+            if pid != None:
+                self.moveIds[(blkId,blkVarId)+tuple(coords.tolist())] = pid
+
+    def _addPlacement(self, known, move, cells):
+        sizeY, sizeZ = self.boardSize[1], self.boardSize[2]
+        mask = 0
+        columns = {} # column -> z of its cubes
+        for x,y,z in cells:
+            col = x*sizeY+y
+            mask |= 1 << (col*sizeZ+z)
+            columns.setdefault(col, []).append(z)
+        if mask in known:
+            return known[mask]
+        # A column with a gap between its cubes can never be supported
+        for zs in columns.itervalues():
+            if max(zs)-min(zs)+1 != len(zs):
+                return None
+        pid = len(self.moves)
+        footprint = tuple(sorted((col, min(zs)) \
+                                 for col, zs in columns.iteritems()))
+        blkId = move[1]
+        self.moves.append(move)
+        self.blkIds.append(blkId)
+        self.masks.append(mask)
+        self.footprints.append(footprint)
+        self.tops.append(tuple((col, low+len(columns[col])) \
+                               for col, low in footprint))
+        self.supports.append(sum(1 << (col*sizeZ+low-1) \
+                                 for col, low in footprint if low > 0))
+        self.byBase[blkId].setdefault(footprint[0], []).append(pid)
+        known[mask] = pid
+        return pid
+
+    def cellArrays(self):
+        """Boolean arrays describing all the placements at once, built on
+           first use : cubes[pid,cell] tells whether a placement covers a
+           cell, neighbours[pid,cell] whether the cell is next to or above
+           it, and columns[pid,col] whether it covers a column"""
+        if self._cellArrays == None:
+            sizeX, sizeY, sizeZ = self.boardSize
+            masks = boardMasks(self.boardSize)
+            nbCells = sizeX*sizeY*sizeZ
+            cubes = zeros((len(self.masks), nbCells), dtype=bool)
+            neighbours = zeros((len(self.masks), nbCells), dtype=bool)
+            columns = zeros((len(self.masks), sizeX*sizeY), dtype=bool)
+            for pid, mask in enumerate(self.masks):
+                cubes[pid, list(iterBits(mask))] = True
+                neighbours[pid, list(iterBits(masks.neighbours(mask) & ~mask))] = True
+                columns[pid, [col for col, _ in self.footprints[pid]]] = True
+            self._cellArrays = (cubes, neighbours, columns)
+        return self._cellArrays
+
+    def placementId(self, move):
+        """Returns the pid corresponding to a move"""
+        coords, blkId, blkVarId = move
+        return self.moveIds[(blkId,blkVarId, \
+                             int(coords[0]),int(coords[1]),int(coords[2]))]
+
+    def fittingPlacements(self, heights, blkIds):
+        """Yields the pids of the given blocks' placements
+           that lie exactly on the height map"""
+        sizeZ = self.boardSize[2]
+        for blkId in blkIds:
+            byBase = self.byBase[blkId]
+            for col, z in enumerate(heights):
+                if z >= sizeZ:
+                    continue
+                for pid in byBase.get((col,z), ()):
+                    for c, low in self.footprints[pid]:
+                        if heights[c] != low:
+                            break
+                    else:
+                        yield pid
+
+_tables = {}
+
+def placementTable(boardSize):
+    """Returns the placement table of a board size,
+       building it on first use"""
+    if boardSize not in _tables:
+        _tables[boardSize] = PlacementTable(boardSize)
+    return _tables[boardSize]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Fast random playouts, for Monte-Carlo evaluations
+"""
+
+from numpy.core.numeric import array
+import random
+
+from blokus3d import instrument
+
+def randomPlacement(gs, rng=random):
+    """Returns the id of a legal placement of the next player
+       picked uniformly at random (None if he has to pass),
+       without building the list of legal moves"""
+    masks = gs.settings.placements.masks
+    allowedMask = gs.allowedCubesMask()
+    # Reservoir sampling, with a reservoir of one placement
+    chosen, count = None, 0
+    for pid in gs.fittingPlacements():
+        if masks[pid] & allowedMask:
+            count += 1
+            if rng.random()*count < 1.:
+                chosen = pid
+    return chosen
+
+def playout(gs, rng=random, maxDepth=None):
+    """Play random moves on gs until the game is over, or until
+       maxDepth blocks have been placed. Returns the number of moves
+       played, so that they can be taken back with undoMove."""
+    nbMoves = depth = 0
+    while not gs.isOver() and (maxDepth==None or depth<maxDepth):
+        pid = randomPlacement(gs, rng)
+        gs.playPlacement(pid)
+        nbMoves += 1
+        if pid != None:
+            depth += 1
+    if instrument.enabled:
+        instrument.count('playouts')
+        instrument.count('playout.moves', nbMoves)
+    return nbMoves
+
+def randomPlayouts(gs, n, maxDepth=None, seed=None):
+    """Scores at the end of n random playouts from gs,
+       as an array of shape (n, nbPlayers). Without a seed,
+       the moves are drawn from the shared random generator."""
+    rng = random.Random(seed) if seed != None else random
+    gs = gs.clone()
+    scores = []
+    for _ in xrange(n):
+        nbMoves = playout(gs, rng, maxDepth)
+        scores.append(gs.finalScores())
+        for _ in xrange(nbMoves):
+            gs.undoMove()
+    return array(scores)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Consistency checks of the incremental game state
+
+Plays seeded random games and checks, after every move, that what
+playPlacement and undoMove maintain incrementally (board, frontiers,
+scores, penalties, Zobrist hashes, symmetric hashes) is the same as
+when it is computed from scratch, that taking moves back restores the
+state exactly, and that clones are equal but independent.
+
+Usage :
+    python -m blokus3d.selfcheck [-g games] [-p players] [-s seed]
+
+The exit status is 1 if some check failed.
+"""
+
+import argparse
+import random
+import sys
+
+from blokus3d.gamestate import GameSettings, GameState
+
+def snapshot(gs):
+    """Everything the game state maintains, as comparable values"""
+    return {'board': gs.board, \
+            'heights': list(gs.bits.heights), \
+            'occupancy': list(gs.bits.occupancy), \
+            'topMask': gs.bits.topMask, \
+            'playerBlocks': [list(blkIds) for blkIds in gs.playerBlocks], \
+            'nextPlayer': gs.nextPlayer, \
+            'firstToPass': gs.firstToPass, \
+            'hashes': list(gs.hashes), \
+            'symHashes': None if gs.symHashes == None \
+                         else [list(hashes) for hashes in gs.symHashes], \
+            'frontier': list(gs.frontier), \
+            'topCounts': list(gs.topCounts), \
+            'penalties': list(gs.penalties)}
+
+def fromScratch(gs):
+    """A game state equal to gs, with everything computed again"""
+    return GameState(gs.settings, [list(blkIds) for blkIds in gs.playerBlocks], \
+                     gs.board, gs.nextPlayer, gs.firstToPass)
+
+def assertSame(expected, actual, what):
+    for name in sorted(expected):
+        assert expected[name] == actual[name], \
+               "%s : %s differs\n%s\n%s" % (what, name, expected[name], actual[name])
+
+def checkGame(settings, seed, probes=5):
+    """Play a random game, checking the state after each move, trying
+       and taking back some other moves on the way, and finally taking
+       back all the moves. Returns the number of moves played."""
+    rng = random.Random(seed)
+    gs = GameState.initState(settings)
+    initial = snapshot(gs)
+    nbMoves = 0
+    while True:
+        before = snapshot(gs)
+        assertSame(snapshot(fromScratch(gs)), before, "move %d" % nbMoves)
+        pids = gs.legalPlacements()
+        for pid in rng.sample(pids, min(probes, len(pids))) or [None]:
+            gs.playPlacement(pid)
+            assertSame(snapshot(fromScratch(gs)), snapshot(gs), \
+                       "move %d, after placement %s" % (nbMoves, pid))
+            gs.undoMove()
+            assertSame(before, snapshot(gs), \
+                       "move %d, after undoing placement %s" % (nbMoves, pid))
+        clone = gs.clone()
+        assertSame(before, snapshot(clone), "move %d, clone" % nbMoves)
+        if gs.isOver():
+            break
+        clone.playPlacement(rng.choice(pids) if pids != [] else None)
+        assertSame(before, snapshot(gs), "move %d, after playing on a clone" % nbMoves)
+        gs.playMove(rng.choice(gs.legalMoves()))
+        nbMoves += 1
+    for _ in xrange(nbMoves):
+        gs.undoMove()
+    assertSame(initial, snapshot(gs), "after undoing the whole game")
+    return nbMoves
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Blokus 3D consistency checks")
+    parser.add_argument('-g', '--games', type=int, default=4, \
+                        help="number of games per settings")
+    parser.add_argument('-p', '--players', default='2,3,4', \
+                        help="numbers of players of the games")
+    parser.add_argument('-s', '--seed', type=int, default=0, \
+                        help="seed of the first game")
+    args = parser.parse_args(args)
+    try:
+        for nbPlayers in map(int, args.players.split(',')):
+            for symmetric in (False, True):
+                settings = GameSettings(nbPlayers, symmetric=symmetric)
+                for seed in xrange(args.seed, args.seed+args.games):
+                    nbMoves = checkGame(settings, seed)
+                    print "%d players%s, seed %d : %d moves ok" % \
+                        (nbPlayers, " (symmetric)" if symmetric else "", seed, nbMoves)
+    except AssertionError as e:
+        print "FAILED", e
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Append-only on-disk store of legal moves, keyed by state hash
+
+A store is made of two files :
+- the data file (path), where each entry is appended as a uint64 key,
+  a uint32 number of moves and then a (x,y,z,blkId,blkVarId) int8 record
+  per move, passing being stored as an entry without any move.
+- the index file (path+'.idx'), a memory-mapped open addressing hash
+  table of (key, offset of the entry in the data file) slots.
+
+Any number of processes can read a store concurrently, without any
+locking. Writers hold an exclusive lock on the index while appending.
+
+As moves are stored with their variation ids, a store can only be used
+with the block variations it was built with, whose checksum is kept in
+the header.
+"""
+
+from numpy.core.numeric import array, frombuffer
+from numpy.core.numerictypes import int8
+from numpy.core.memmap import memmap
+from numpy import dtype
+import fcntl
+import mmap
+import os
+import struct
+
+from blokus3d.block import blockVarTable
+
+dataMagic = 'B3DMOVES'
+indexMagic = 'B3DINDEX'
+# Header : magic, format version, number of slots (index only),
+# checksum of the block variations
+headerFormat = '<8sIII'
+headerSize = struct.calcsize(headerFormat)
+entryFormat = '<QI'
+entrySize = struct.calcsize(entryFormat)
+moveDtype = dtype([('x',int8),('y',int8),('z',int8),('blkId',int8),('blkVarId',int8)])
+slotDtype = dtype([('key','<u8'),('offset','<u8')])
+formatVersion = 2
+# Beyond this many probes, the index is considered full
+maxProbes = 256
+
+class StoreFullError(Exception):
+    pass
+
+class LegalMovesStore(object):
+    """Persistent mapping from state hashes to lists of moves,
+       given as (x,y,z,blkId,blkVarId) tuples or None for passing"""
+
+    def __init__(self, path, nbSlots=2**22, readOnly=False):
+        self.path = path
+        self.readOnly = readOnly
+        if not readOnly and not os.path.exists(path+'.idx'):
+            self._create(nbSlots)
+        with open(path+'.idx','rb') as f:
+            magic, version, self.nbSlots, variations \
+                = struct.unpack(headerFormat, f.read(headerSize))
+        assert magic == indexMagic and version == formatVersion, \
+               "%s is not a legal moves store" % path
+        assert variations == blockVarTable().checksum, \
+               "%s was built with other block variations" % path
+        self.index = memmap(path+'.idx', dtype=slotDtype, \
+                            mode='r' if readOnly else 'r+', \
+                            offset=headerSize, shape=(self.nbSlots,))
+        self.dataFile = open(path, 'rb' if readOnly else 'r+b')
+        self.data = None
+        self.dataSize = 0
+
+    def _create(self, nbSlots):
+        # Create the data file first, so the index is only
+        # found by other processes once both files exist
+        with open(self.path,'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if f.tell() == 0:
+                f.write(struct.pack(headerFormat, dataMagic, formatVersion, 0, \
+                                    blockVarTable().checksum))
+        with open(self.path+'.idx','ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if f.tell() == 0:
+                f.write(struct.pack(headerFormat, indexMagic, formatVersion, nbSlots, \
+                                    blockVarTable().checksum))
+                # Sparse file, filled with empty slots
+                f.truncate(headerSize+nbSlots*slotDtype.itemsize)
+
+    def _remap(self, size):
+        """Map the data file again if it grew past size"""
+        if size > self.dataSize:
+            if self.data != None:
+                self.data.close()
+            self.dataSize = os.fstat(self.dataFile.fileno()).st_size
+            self.data = mmap.mmap(self.dataFile.fileno(), self.dataSize, \
+                                  access=mmap.ACCESS_READ)
+
+    def _slot(self, key):
+        """Index of the slot of key, or of the empty slot where it would go"""
+        slot = key % self.nbSlots
+        for _ in xrange(min(maxProbes, self.nbSlots)):
+            offset = self.index['offset'][slot]
+            # As an int, since numpy compares uint64 and long as floats
+            if offset == 0 or int(self.index['key'][slot]) == key:
+                return slot
+            slot = (slot+1) % self.nbSlots
+        return None
+
+    def get(self, key, default=None):
+        slot = self._slot(key)
+        if slot == None:
+            return default
+        offset = int(self.index['offset'][slot])
+        if offset == 0:
+            return default
+        self._remap(offset+entrySize)
+        storedKey, count = struct.unpack_from(entryFormat, self.data, offset)
+        assert storedKey == key
+        if count == 0:
+            return [None]
+        self._remap(offset+entrySize+count*moveDtype.itemsize)
+        records = frombuffer(self.data, dtype=moveDtype, count=count, \
+                             offset=offset+entrySize)
+        return [tuple(map(int, record)) for record in records]
+
+    def __contains__(self, key):
+        return self.get(key) != None
+
+    def put(self, key, moves):
+        """Append the moves of a state, unless already there"""
+        assert not self.readOnly
+        with open(self.path+'.idx','rb') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            slot = self._slot(key)
+            if slot == None:
+                raise StoreFullError(self.path)
+            if self.index['offset'][slot] != 0:
+                return
+            moves = [m for m in moves if m != None]
+            records = array(moves, dtype=moveDtype)
+            self.dataFile.seek(0, os.SEEK_END)
+            offset = self.dataFile.tell()
+            self.dataFile.write(struct.pack(entryFormat, key, len(moves)))
+            self.dataFile.write(records.tostring())
+            self.dataFile.flush()
+            # The key goes first, so that readers which find
+            # the offset can be sure the key is there too
+            self.index['key'][slot] = key
+            self.index['offset'][slot] = offset
+
+    def __len__(self):
+        return int((self.index['offset'] != 0).sum())
+
+    def flush(self):
+        if not self.readOnly:
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        if self.data != None:
+            self.data.close()
+        self.dataFile.close()
+        del self.index
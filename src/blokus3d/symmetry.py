@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Reflections of the board
+
+The board can be flipped along x, along y, or both (which amounts to a
+half turn). Each block must then be mapped onto a block that can take
+all the mirrored shapes of its variations : itself, or its mirror image
+for a chiral block. Everything is derived from the placement table, so
+that this follows from the blocks' shapes, and the symmetries for which
+some block has no image are left out.
+
+With the block variations of block.blockVarTable, the two helices can
+take some (but not all) of each other's shapes, so only the half turn
+is kept.
+"""
+
+from itertools import izip
+
+from blokus3d.block import nbBlocks
+from blokus3d.placement import placementTable
+from blokus3d.bitboard import iterBits
+
+# (flip x, flip y) of the candidate symmetries
+symmetries = ((False,False), (True,False), (False,True), (True,True))
+
+class SymmetryTable(object):
+    """The symmetries of a board size, symmetries[s] being the (flip x,
+       flip y) pair of the sth one (the identity being the first one).
+       cells[s][cell], placements[s][pid] and blocks[s][blkId] are the
+       images of a cell, placement or block by symmetry s. As every
+       symmetry is its own inverse, they also give the preimages."""
+
+    def __init__(self, boardSize):
+        self.boardSize = boardSize
+        table = placementTable(boardSize)
+        pids = dict(((blkId, mask), pid) for pid, (blkId, mask) \
+                    in enumerate(izip(table.blkIds, table.masks)))
+        masks = [set() for _ in xrange(nbBlocks)]
+        for blkId, mask in izip(table.blkIds, table.masks):
+            masks[blkId].add(mask)
+        self.symmetries = []
+        self.cells = []
+        self.placements = []
+        self.blocks = []
+        for flipX, flipY in symmetries:
+            cells = self._mirrorCells(flipX, flipY)
+            mirror = lambda mask: self._mirrorMask(mask, cells)
+            # The image of a block is the one that can take all the
+            # mirrored placements of this block, preferably itself
+            blocks = []
+            for blkId in xrange(nbBlocks):
+                images = set(map(mirror, masks[blkId]))
+                candidates = [other for other in [blkId]+range(nbBlocks) \
+                              if images <= masks[other]]
+                if candidates == []:
+                    break
+                blocks.append(candidates[0])
+            else:
+                self.symmetries.append((flipX, flipY))
+                self.cells.append(cells)
+                self.blocks.append(blocks)
+                self.placements.append([pids[(blocks[blkId], mirror(mask))] \
+                    for blkId, mask in izip(table.blkIds, table.masks)])
+
+    def _mirrorCells(self, flipX, flipY):
+        sizeX, sizeY, sizeZ = self.boardSize
+        cells = []
+        for x in xrange(sizeX):
+            for y in xrange(sizeY):
+                col = (sizeX-1-x if flipX else x)*sizeY \
+                      + (sizeY-1-y if flipY else y)
+                cells.extend(col*sizeZ+z for z in xrange(sizeZ))
+        return cells
+
+    def _mirrorMask(self, mask, cells):
+        image = 0
+        for cell in iterBits(mask):
+            image |= 1 << cells[cell]
+        return image
+
+    def mirrorMask(self, mask, s):
+        """Image of a mask of cells by symmetry s"""
+        return self._mirrorMask(mask, self.cells[s])
+
+    def mirrorBlocks(self, blkIds, s):
+        """Images of a list of block ids by symmetry s"""
+        return [self.blocks[s][blkId] for blkId in blkIds]
+
+    def invariantSymmetries(self, gs):
+        """Symmetries (besides the identity) that leave a game state unchanged"""
+        return [s for s in xrange(1, len(self.symmetries)) \
+                if all(self.mirrorMask(occupancy, s) == occupancy \
+                       for occupancy in gs.bits.occupancy) \
+                and all(sorted(self.mirrorBlocks(blkIds, s)) == sorted(blkIds) \
+                        for blkIds in gs.playerBlocks)]
+
+    def pruneSymmetricPlacements(self, gs, pids):
+        """Keeps one placement out of each set of placements leading to
+           states that are reflections of one another (which is only
+           possible when gs is its own reflection)"""
+        invariant = self.invariantSymmetries(gs)
+        if invariant == []:
+            return pids
+        return [pid for pid in pids \
+                if all(pid <= self.placements[s][pid] for s in invariant)]
+
+_tables = {}
+
+def symmetryTable(boardSize):
+    """Returns the symmetry table of a board size,
+       building it on first use"""
+    if boardSize not in _tables:
+        _tables[boardSize] = SymmetryTable(boardSize)
+    return _tables[boardSize]
+
+def pruneSymmetricMoves(gs, moves):
+    """Same as SymmetryTable.pruneSymmetricPlacements, given moves"""
+    if moves == [None]:
+        return moves
+    table = gs.settings.placements
+    pids = symmetryTable(gs.boardSize).pruneSymmetricPlacements(gs, \
+               [table.placementId(move) for move in moves])
+    return [table.moves[pid] for pid in pids]
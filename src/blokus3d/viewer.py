@@ -14,8 +14,7 @@ from numpy.core.numeric import array
 from numpy.linalg import norm
 from itertools import imap
 
-from blokus3d.block import sortCubes2
-from blokus3d.gamestate import blockVarWithOrigin
+from blokus3d.block import sortCubes2, blockVarWithOrigin
 from blokus3d.utils import bound
 
 white = soya.Material()
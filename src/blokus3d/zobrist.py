@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Zobrist hashing of game states
+
+Players are numbered relatively to the player whose turn it is,
+so that states that only differ by a rotation of the players
+(e.g., the same board seen by the next player) have the same hash.
+"""
+
+from numpy.random import RandomState
+from numpy.core.numerictypes import uint64
+
+from blokus3d.block import nbBlocks
+from blokus3d.bitboard import iterBits
+
+# Fixed seed, so that hashes are the same in every process
+zobristSeed = 0xB10C5
+
+class ZobristTable(object):
+    """Random 64-bit keys of a board size and number of players :
+       cubes[cell][k] for a cube of the kth player after the next one,
+       blocks[k][blkId] for a block still owned by this player"""
+
+    def __init__(self, boardSize, nbPlayers):
+        self.boardSize = boardSize
+        self.nbPlayers = nbPlayers
+        nbCells = boardSize[0]*boardSize[1]*boardSize[2]
+        rs = RandomState(zobristSeed + 1000*nbPlayers + nbCells)
+        self.cubes = rs.randint(0, 2**64, size=(nbCells, nbPlayers), \
+                                dtype=uint64).tolist()
+        self.blocks = rs.randint(0, 2**64, size=(nbPlayers, nbBlocks), \
+                                 dtype=uint64).tolist()
+        self._placementKeys = None
+
+    def placementKeys(self, table):
+        """placementKeys(table)[pid][k] is the xor of the cube keys of
+           a placement of the kth player after the next one, computed
+           on first use for the given placement table"""
+        if self._placementKeys == None:
+            keys = []
+            for mask in table.masks:
+                pk = [0]*self.nbPlayers
+                for cell in iterBits(mask):
+                    for k in xrange(self.nbPlayers):
+                        pk[k] ^= self.cubes[cell][k]
+                keys.append(tuple(pk))
+            self._placementKeys = keys
+        return self._placementKeys
+
+    def hashes(self, occupancy, playerBlocks):
+        """Hash of a state for each possible next player"""
+        n = self.nbPlayers
+        hashes = []
+        for nextPlayer in xrange(n):
+            h = 0
+            for player in xrange(n):
+                k = (player-nextPlayer) % n
+                for cell in iterBits(occupancy[player]):
+                    h ^= self.cubes[cell][k]
+                for blkId in playerBlocks[player]:
+                    h ^= self.blocks[k][blkId]
+            hashes.append(h)
+        return hashes
+
+_tables = {}
+
+def zobristTable(boardSize, nbPlayers):
+    """Returns the Zobrist table of a board size
+       and number of players, building it on first use"""
+    if (boardSize, nbPlayers) not in _tables:
+        _tables[(boardSize, nbPlayers)] = ZobristTable(boardSize, nbPlayers)
+    return _tables[(boardSize, nbPlayers)]